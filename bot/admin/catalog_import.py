@@ -0,0 +1,292 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import zipfile
+from dataclasses import dataclass
+
+from aiogram import Bot, Router, html
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.filters import Command
+from aiogram.types import BufferedInputFile, Message
+
+import database.requests as rq
+from admin.handler_add_data import ALLOWED_FILE_TYPES, MAX_FILE_SIZE_MB, MAX_PHOTO_SIZE_MB, MAX_PRICE, MIN_PRICE
+from database.catalog import catalog
+from utils.delivery import ADMIN_IDS, DATA_NAMES
+from utils.file_health import ORIGINALS_DIR
+from utils.ratelimit import Lane, PerChatLimiter, lane
+from utils.scheduler import deletions
+
+router = Router()
+
+logger = logging.getLogger(__name__)
+
+# Боты могут скачивать из Telegram файлы не больше 20 МБ
+MAX_ARCHIVE_SIZE_MB = 20
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', 3))
+IMPORT_RETRIES = 3
+PHOTO_TYPES = ('image/jpeg', 'image/png')
+MANIFEST_NAMES = ('manifest.json', 'manifest.csv')
+MAX_ERRORS_SHOWN = 30
+
+IMPORT_HELP = (
+    "📦 Массовая загрузка каталога\n\n"
+    "Отправьте ZIP-архив (до 20MB) с подписью /import. В архиве - файл manifest.json "
+    "или manifest.csv и сами обложки и файлы товаров.\n\n"
+    "Поля каждого товара:\n"
+    "• type - gaid или kurs\n"
+    "• name - название (от 3 символов)\n"
+    "• description - описание (от 10 символов)\n"
+    "• photo - путь к обложке в архиве (jpg/png, до 5MB)\n"
+    "• file - путь к файлу в архиве (PDF, Word, txt, до 20MB)\n"
+    "• price_card - цена в рублях\n"
+    "• price_star - цена в звёздах\n\n"
+    "Если хоть один товар не проходит проверку, не добавляется ничего."
+)
+
+
+class CatalogImportError(Exception):
+    """Архив нельзя импортировать целиком: нет манифеста, битый ZIP и т.п."""
+
+
+@dataclass
+class ImportItem:
+    data_type: str
+    name: str
+    description: str
+    photo: str
+    file: str
+    price_card: int
+    price_star: int
+    photo_id: str | None = None
+    file_id: str | None = None
+
+    def values(self) -> dict:
+        data_type = self.data_type
+        return {
+            f'name_fail_{data_type}': self.name,
+            f'photo_{data_type}': self.photo_id,
+            f'description_{data_type}': self.description,
+            f'fail_{data_type}': self.file_id,
+            f'price_card_{data_type}': self.price_card,
+            f'price_star_{data_type}': self.price_star,
+        }
+
+
+def read_manifest(archive: zipfile.ZipFile) -> tuple[str, list[dict]]:
+    """Ищет манифест (в корне архива или в единственной папке) и возвращает его папку и строки."""
+    candidates = sorted(
+        (name for name in archive.namelist() if posixpath.basename(name) in MANIFEST_NAMES),
+        key=lambda name: name.count('/'),
+    )
+    if not candidates:
+        raise CatalogImportError("В архиве нет manifest.json или manifest.csv")
+    name = candidates[0]
+    text = archive.read(name).decode('utf-8-sig')
+    if name.endswith('.json'):
+        try:
+            rows = json.loads(text)
+        except ValueError as e:
+            raise CatalogImportError(f"manifest.json не читается: {e}")
+        if isinstance(rows, dict):
+            rows = rows.get('items')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise CatalogImportError("manifest.json должен быть списком товаров")
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    if not rows:
+        raise CatalogImportError("Манифест пуст")
+    return posixpath.dirname(name), rows
+
+
+def validate_member(archive: zipfile.ZipFile, path: str, kind: str) -> str | None:
+    """Проверяет обложку или файл по тем же правилам, что и пошаговое добавление."""
+    try:
+        info = archive.getinfo(path)
+    except KeyError:
+        return f"нет файла {path} в архиве"
+    mime_type = mimetypes.guess_type(path)[0]
+    size_mb = info.file_size / (1024 * 1024)
+    if kind == 'photo':
+        if mime_type not in PHOTO_TYPES:
+            return f"обложка {path} должна быть jpg или png"
+        if size_mb > MAX_PHOTO_SIZE_MB:
+            return f"обложка {path} слишком большая ({size_mb:.1f}MB, максимум {MAX_PHOTO_SIZE_MB}MB)"
+    else:
+        if not mime_type or not any(mime_type.startswith(t) for t in ALLOWED_FILE_TYPES):
+            return f"неподдерживаемый формат файла {path}: {mime_type or 'неизвестный'}"
+        if not info.file_size or size_mb > MAX_FILE_SIZE_MB:
+            return f"файл {path} пустой или больше {MAX_FILE_SIZE_MB}MB"
+    return None
+
+
+def parse_archive(data: bytes, existing_names: dict[str, set[str]]) -> tuple[list[ImportItem], list[str]]:
+    """Разбирает архив и проверяет все товары. Возвращает товары и список ошибок."""
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile:
+        raise CatalogImportError("Это не ZIP-архив или он поврежден")
+    with archive:
+        base, rows = read_manifest(archive)
+        items, errors = [], []
+        seen = {data_type: set(names) for data_type, names in existing_names.items()}
+        for number, row in enumerate(rows, start=1):
+            row = {str(key).strip(): str(value).strip() for key, value in row.items() if key is not None and value is not None}
+            name = row.get('name', '')
+            label = f"{number} «{name}»" if name else str(number)
+            row_errors = []
+
+            data_type = row.get('type', '').lower()
+            if data_type not in DATA_NAMES:
+                row_errors.append("type должен быть gaid или kurs")
+            if len(name) < 3:
+                row_errors.append("название короче 3 символов")
+            elif data_type in seen:
+                if name in seen[data_type]:
+                    row_errors.append("такое название уже есть")
+                seen[data_type].add(name)
+            if len(row.get('description', '')) < 10:
+                row_errors.append("описание короче 10 символов")
+
+            prices = {}
+            for field in ('price_card', 'price_star'):
+                value = row.get(field, '')
+                if not value.isdigit() or not MIN_PRICE <= int(value) <= MAX_PRICE:
+                    row_errors.append(f"{field} должна быть числом от {MIN_PRICE} до {MAX_PRICE}")
+                else:
+                    prices[field] = int(value)
+
+            paths = {}
+            for kind in ('photo', 'file'):
+                if not row.get(kind):
+                    row_errors.append(f"не указан {kind}")
+                    continue
+                paths[kind] = posixpath.normpath(posixpath.join(base, row[kind]))
+                error = validate_member(archive, paths[kind], kind)
+                if error:
+                    row_errors.append(error)
+
+            if row_errors:
+                errors.append(f"Строка {label}: " + "; ".join(row_errors))
+                continue
+            items.append(ImportItem(
+                data_type=data_type, name=name, description=row['description'],
+                photo=paths['photo'], file=paths['file'], **prices,
+            ))
+        return items, errors
+
+
+class CatalogImporter:
+    """Загружает обложки и файлы товаров в чат админа, чтобы получить их file_id.
+
+    Загрузки идут параллельно, но не больше IMPORT_CONCURRENCY одновременно, в
+    полосе Lane.ADMIN общего лимитера и не чаще раза в секунду в чат, как у рассылки,
+    чтобы не ловить 429. Служебные сообщения с медиа сразу ставятся на удаление.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, archive: zipfile.ZipFile):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.archive = archive
+        self.semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+        self.chat_limiter = PerChatLimiter()
+
+    async def _send(self, kind: str, path: str) -> str:
+        # Распаковка файла до 20MB - не в цикле событий
+        media = BufferedInputFile(await asyncio.to_thread(self.archive.read, path), filename=posixpath.basename(path))
+        for attempt in range(IMPORT_RETRIES):
+            await self.chat_limiter.acquire(self.chat_id)
+            try:
+                with lane(Lane.ADMIN):
+                    if kind == 'photo':
+                        message = await self.bot.send_photo(self.chat_id, media, disable_notification=True)
+                        file_id = message.photo[-1].file_id
+                    else:
+                        message = await self.bot.send_document(self.chat_id, media, disable_notification=True)
+                        file_id = message.document.file_id
+                deletions.schedule(message, 0)
+                return file_id
+            except TelegramRetryAfter as e:
+                if attempt == IMPORT_RETRIES - 1:
+                    raise
+                self.chat_limiter.pause(self.chat_id, e.retry_after)
+
+    async def _upload(self, item: ImportItem):
+        async with self.semaphore:
+            item.photo_id = await self._send('photo', item.photo)
+            item.file_id = await self._send('file', item.file)
+
+    async def upload(self, items: list[ImportItem]):
+        await asyncio.gather(*(self._upload(item) for item in items))
+
+
+def save_originals(archive: zipfile.ZipFile, items: list[ImportItem], ids: list[int]):
+    """Кладет оригиналы в хранилище, из которого проверка файлов восстанавливает битые file_id."""
+    for item, item_id in zip(items, ids):
+        directory = ORIGINALS_DIR / item.data_type / str(item_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        for kind, path in (('photo', item.photo), ('fail', item.file)):
+            (directory / f'{kind}{posixpath.splitext(path)[1]}').write_bytes(archive.read(path))
+
+
+@router.message(Command(commands='import'))
+async def import_catalog(message: Message, bot: Bot):
+    """Массовое добавление товаров из ZIP-архива с манифестом."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer('Эта команда не для вас)')
+        return
+    document = message.document
+    if document is None:
+        await message.answer(IMPORT_HELP)
+        return
+    if not (document.file_name or '').lower().endswith('.zip'):
+        await message.answer("❌ Нужен ZIP-архив.\n\n" + IMPORT_HELP)
+        return
+    if document.file_size and document.file_size > MAX_ARCHIVE_SIZE_MB * 1024 * 1024:
+        await message.answer(f"❌ Архив больше {MAX_ARCHIVE_SIZE_MB}MB. Разбейте каталог на несколько архивов.")
+        return
+
+    logger.info(f"[IMPORT] Импорт каталога из {document.file_name} от {message.from_user.id}")
+    data = (await bot.download(document)).read()
+    snapshot = await catalog.get()
+    existing_names = {data_type: set(names) for data_type, names in snapshot.by_name.items()}
+    try:
+        items, errors = await asyncio.to_thread(parse_archive, data, existing_names)
+    except CatalogImportError as e:
+        await message.answer(f"❌ {e}")
+        return
+    if errors:
+        text = [f"❌ Архив не прошел проверку, ничего не добавлено. Ошибок: {len(errors)}"]
+        text.extend(f"• {html.quote(error)}" for error in errors[:MAX_ERRORS_SHOWN])
+        if len(errors) > MAX_ERRORS_SHOWN:
+            text.append(f"... и еще {len(errors) - MAX_ERRORS_SHOWN}")
+        await message.answer('\n'.join(text))
+        return
+
+    # Две загрузки на товар, не чаще раза в секунду в чат
+    progress = await message.answer(f"⏳ Проверка пройдена, загружаю файлы {len(items)} товаров, "
+                                    f"это займет около {max(1, round(len(items) * 2 / 60))} мин...")
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        try:
+            await CatalogImporter(bot, message.chat.id, archive).upload(items)
+            ids = await rq.add_catalog_items([(item.data_type, item.values()) for item in items])
+        except Exception as e:
+            logger.error(f"[IMPORT] Ошибка импорта каталога: {e}", exc_info=True)
+            await progress.edit_text(f"⚠️ Импорт прерван, ничего не добавлено: {html.quote(str(e))}")
+            return
+        try:
+            await asyncio.to_thread(save_originals, archive, items, ids)
+        except Exception as e:
+            logger.warning(f"[IMPORT] Не удалось сохранить оригиналы: {e}")
+
+    counts = {data_type: sum(item.data_type == data_type for item in items) for data_type in DATA_NAMES}
+    logger.info(f"[IMPORT] Добавлено товаров: {counts}")
+    await progress.edit_text(
+        "✅ Каталог загружен!\n"
+        + "\n".join(f"{DATA_NAMES[data_type]}: {count}" for data_type, count in counts.items() if count)
+    )
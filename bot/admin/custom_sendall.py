@@ -1,17 +1,25 @@
+import asyncio
+
 from aiogram import F, Router, Bot
 from aiogram.types import CallbackQuery, Message
 from dotenv import load_dotenv
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.exceptions import TelegramBadRequest
 
-import database.requests as rq
+from utils.broadcast import start_broadcast
 
 router = Router()
 
 load_dotenv()
 
 
+# Сколько ждать остальные сообщения альбома после первого
+ALBUM_COLLECT_DELAY = 1.0
+
+albums: dict[str, list[int]] = {}
+album_tasks: set[asyncio.Task] = set()
+
+
 class Custom_message(StatesGroup):
     msg_custom = State()
 
@@ -23,126 +31,37 @@ async def function_custom_message(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer(text='Введите ваше сообщение (или отправьте медиа):')
 
 
+async def start_custom_broadcast(bot: Bot, admin_id: int, calls: list[dict]):
+    if await start_broadcast(bot, 'custom', calls, admin_id):
+        await bot.send_message(admin_id, text='Рассылка запущена, по окончании пришлю отчет.')
+    else:
+        await bot.send_message(admin_id, text='Эта рассылка уже идет.')
+
+
+async def flush_album(bot: Bot, state: FSMContext, media_group_id: str, chat_id: int, admin_id: int):
+    """Ждет остальные сообщения альбома и рассылает его целиком."""
+    await asyncio.sleep(ALBUM_COLLECT_DELAY)
+    message_ids = sorted(albums.pop(media_group_id, []))
+    await state.clear()
+    calls = [{'method': 'copy_messages', 'params': {'from_chat_id': chat_id, 'message_ids': message_ids}}]
+    await start_custom_broadcast(bot, admin_id, calls)
+
+
 @router.message(Custom_message.msg_custom)
 async def get_custom_message(message: Message, state: FSMContext, bot: Bot):
-    users = await rq.get_users()
-    success_count = 0
-    failure_count = 0
-
-    if message.text:
-        custom_text = message.text
-        for user in users:
-            try:
-                await bot.send_message(chat_id=user.tg_id, text=custom_text)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке сообщения пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    elif message.photo:
-        file_id = message.photo[-1].file_id
-        caption = message.caption
-        for user in users:
-            try:
-                await bot.send_photo(chat_id=user.tg_id, photo=file_id, caption=caption)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке фото пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    elif message.video:
-        file_id = message.video.file_id
-        caption = message.caption
-        for user in users:
-            try:
-                await bot.send_video(chat_id=user.tg_id, video=file_id, caption=caption)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке видео пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    elif message.document:
-        file_id = message.document.file_id
-        caption = message.caption
-        for user in users:
-            try:
-                await bot.send_document(chat_id=user.tg_id, document=file_id, caption=caption)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке документа пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-    
-    elif message.animation:
-        file_id = message.animation.file_id
-        caption = message.caption
-        for user in users:
-            try:
-                await bot.send_animation(chat_id=user.tg_id, animation=file_id, caption=caption)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке GIF пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    elif message.sticker:
-        file_id = message.sticker.file_id
-        for user in users:
-            try:
-                await bot.send_sticker(chat_id=user.tg_id, sticker=file_id)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке стикера пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    else:
-        await bot.send_message(message.from_user.id, text='Неподдерживаемый тип сообщения.')
-        await state.clear()
+    # Альбом приходит несколькими апдейтами, собираем его по media_group_id
+    if message.media_group_id:
+        if message.media_group_id not in albums:
+            albums[message.media_group_id] = []
+            task = asyncio.create_task(
+                flush_album(bot, state, message.media_group_id, message.chat.id, message.from_user.id)
+            )
+            album_tasks.add(task)
+            task.add_done_callback(album_tasks.discard)
+        albums[message.media_group_id].append(message.message_id)
         return
 
-    if success_count > 0:
-        await bot.send_message(message.from_user.id, text=f'Успешная рассылка. Отправлено {success_count} пользователям. Не удалось отправить {failure_count} пользователям.')
-    else:
-        await bot.send_message(message.from_user.id, text=f'Не успешная рассылка. Не удалось отправить {failure_count} пользователям.')
-
-    await state.clear()
\ No newline at end of file
+    # copy_message повторяет исходное сообщение админа любого типа одним запросом
+    calls = [{'method': 'copy_message', 'params': {'from_chat_id': message.chat.id, 'message_id': message.message_id}}]
+    await start_custom_broadcast(bot, message.from_user.id, calls)
+    await state.clear()
@@ -0,0 +1,43 @@
+from aiogram import Router, html
+from aiogram.filters import Command
+from aiogram.types import CallbackQuery, Message
+
+import database.requests as rq
+import keyboards.keyboard as kb
+from utils.delivery import ADMIN_IDS, DATA_NAMES
+from utils.delivery_queue import delivery_queue
+
+router = Router()
+
+
+@router.message(Command(commands='deliveries'))
+async def dead_deliveries(message: Message):
+    """Выдачи, которые не удалось отправить после всех попыток, с кнопкой повтора."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer('Эта команда не для вас)')
+        return
+    rows = await rq.get_dead_deliveries()
+    if not rows:
+        await message.answer('Все оплаченные файлы доставлены 👌')
+        return
+    for delivery, tg_name, item_name in rows:
+        await message.answer(
+            f"Заказ №{delivery.order_id}: {DATA_NAMES.get(delivery.data_type, '').lower()} «{html.quote(item_name or '')}»\n"
+            f"Покупатель: {html.quote(tg_name or '')} (<code>{delivery.tg_id}</code>)\n"
+            f"Попыток: {delivery.attempts}\n"
+            f"Ошибка: {html.quote((delivery.last_error or '')[:300])}",
+            reply_markup=kb.dead_delivery_keyboard(delivery.id)
+        )
+
+
+@router.callback_query(kb.DeliveryRetry.filter())
+async def retry_delivery(callback: CallbackQuery, callback_data: kb.DeliveryRetry):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer('Эта кнопка не для вас)')
+        return
+    if await rq.requeue_delivery(callback_data.delivery_id):
+        delivery_queue.notify()
+        await callback.answer('Выдача снова в очереди')
+        await callback.message.edit_reply_markup(reply_markup=None)
+    else:
+        await callback.answer('Выдача уже в работе или доставлена')
@@ -0,0 +1,22 @@
+from aiogram import Router
+from aiogram.filters import Command
+from aiogram.types import Message
+
+from utils.delivery import ADMIN_IDS
+from utils.file_health import file_health
+
+router = Router()
+
+
+@router.message(Command(commands='checkfiles'))
+async def check_files(message: Message):
+    """Внеплановая проверка file_id каталога с отчетом."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer('Эта команда не для вас)')
+        return
+    if file_health.lock.locked():
+        await message.answer('Проверка уже идет, попробуйте чуть позже.')
+        return
+    await message.answer('Проверяю файлы каталога...')
+    report = await file_health.check()
+    await message.answer(report.text())
@@ -5,6 +5,7 @@ from aiogram.fsm.context import FSMContext
 import logging
 import sys
 import sqlite3
+from sqlalchemy.exc import IntegrityError
 
 import database.requests as rq
 
@@ -26,6 +27,12 @@ MAX_PHOTO_SIZE_MB = 5
 MAX_FILE_SIZE_MB = 20
 MIN_PRICE = 0
 MAX_PRICE = 100000
+ALLOWED_FILE_TYPES = [
+    'application/pdf',
+    'application/vnd.openxmlformats-officedocument',
+    'application/msword',
+    'text/plain'
+]
 
 class AddDataStates(StatesGroup):
     name = State()
@@ -241,14 +248,7 @@ class DataHandler:
                 await message.answer("⚠️ Не удалось получить полную информацию о файле. Попробуйте другой файл.")
                 return
 
-            allowed_types = [
-                'application/pdf',
-                'application/vnd.openxmlformats-officedocument',
-                'application/msword',
-                'text/plain'
-            ]
-            
-            if not document.mime_type or not any(document.mime_type.startswith(t) for t in allowed_types):
+            if not document.mime_type or not any(document.mime_type.startswith(t) for t in ALLOWED_FILE_TYPES):
                 warn_msg = f"Неподдерживаемый формат файла: {document.mime_type or 'неизвестный'}"
                 logger.warning(warn_msg)
                 await message.answer(
@@ -435,7 +435,7 @@ class DataHandler:
                 await message.answer(success_msg)
                 await state.clear()
                 
-            except sqlite3.IntegrityError as e:
+            except (sqlite3.IntegrityError, IntegrityError) as e:
                 error_msg = f"[ERROR] Ошибка целостности БД при сохранении {self.data_type}: {str(e)}"
                 logger.error(error_msg, exc_info=True)
                 await message.answer(
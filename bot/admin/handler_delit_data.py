@@ -68,17 +68,17 @@ class DataDelit:
         data_name = "гайд" if self.data_type == "gaid" else "курс"
         await callback.message.answer(f'⚠️Если вы нажмете на {data_name}, он будет удален!\nВсе {data_name}ы в базе:', reply_markup=await keyboard_func())
 
-    async def delete_data(self, callback: CallbackQuery):
+    async def delete_data(self, callback: CallbackQuery, callback_data: kb.CatalogItem):
         await callback.answer('')
-        selection_id = callback.data.split('_')[1]
-        func_delit = getattr(rq, f'get_{self.data_type}')
-        items = await func_delit(selection_id)
-        for item in items:
-            data_name = (
-                item.name_fail_gaid if self.data_type == 'gaid' else item.name_fail_kurs
-            )
+        item_id = callback_data.item_id
+        func_delit = getattr(rq, f'get_{self.data_type}_by_id')
+        items = await func_delit(item_id)
+        if not items:
+            await callback.message.answer('Уже удален!')
+            return
+        data_name = getattr(items[0], f'name_fail_{self.data_type}')
         func_delit = getattr(rq, f'drop_table_{self.data_type}')
-        await func_delit(selection_id)
+        await func_delit(item_id)
         await callback.message.answer(f'{data_name} удален!')
 
 
@@ -90,14 +90,14 @@ delit_kurs = DataDelit('kurs')
 async def start_on_delit_gaid(callback: CallbackQuery, bot: Bot):
     await delit_gaid.select_data_for_delete(callback, bot)
     
-@router.callback_query(F.data.startswith('delitg_'))
-async def drop_gaid(callback: CallbackQuery):
-    await delit_gaid.delete_data(callback)
+@router.callback_query(kb.CatalogItem.filter((F.action == 'delete') & (F.data_type == 'gaid')))
+async def drop_gaid(callback: CallbackQuery, callback_data: kb.CatalogItem):
+    await delit_gaid.delete_data(callback, callback_data)
 
 @router.callback_query(F.data.startswith('keyboard_delete_kurs'))
 async def start_on_delit_kurs(callback: CallbackQuery, bot: Bot):
     await delit_kurs.select_data_for_delete(callback, bot)
 
-@router.callback_query(F.data.startswith('delitk_'))
-async def drop_kurs(callback: CallbackQuery):
-    await delit_kurs.delete_data(callback)
\ No newline at end of file
+@router.callback_query(kb.CatalogItem.filter((F.action == 'delete') & (F.data_type == 'kurs')))
+async def drop_kurs(callback: CallbackQuery, callback_data: kb.CatalogItem):
+    await delit_kurs.delete_data(callback, callback_data)
\ No newline at end of file
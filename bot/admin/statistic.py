@@ -1,34 +1,62 @@
-from aiogram import F, Router, Bot
-from aiogram.types import CallbackQuery, FSInputFile
-import os
-import json
+from aiogram import F, Router, Bot, html
+from aiogram.filters import Command, CommandObject
+from aiogram.types import CallbackQuery, BufferedInputFile, Message
+from collections import Counter
+import asyncio
+import csv
+import io
+
+import database.requests as rq
+from database.catalog import catalog
+from utils.delivery import ADMIN_IDS, DATA_NAMES
+from utils.funnel import funnel, STAGES, STAGE_NAMES
+from handlers.handler_output_data import pre_checkout_latency
 
 router = Router()
 
-GAID_DATA_JSON = "gaid_data.json"
-KURS_DATA_JSON = "kurs_data.json"
-GAID_DATA_TXT = "gaid_data.txt"
-KURS_DATA_TXT = "kurs_data.txt"
+DAILY_DAYS = 30
 
 
-async def convert_json_to_txt(json_file, txt_file):
-    """Converts a JSON file to a TXT file."""
-    try:
-        with open(json_file, 'r', encoding='utf-8') as f_json:
-            data = json.load(f_json)
-
-        with open(txt_file, 'w', encoding='utf-8') as f_txt:
-            json.dump(data, f_txt, ensure_ascii=False, indent=4)
-        return True
-    except FileNotFoundError:
-        print(f"Error: JSON file {json_file} not found.")
-        return False
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON format in {json_file}.")
-        return False
-    except Exception as e:
-        print(f"An error occurred during conversion: {e}")
-        return False
+def conversion(buyers, viewers):
+    return f"{buyers / viewers * 100:.1f}" if viewers else ''
+
+
+def to_csv(header, rows):
+    """CSV в памяти; utf-8-sig, чтобы Excel сам понял кириллицу."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+def build_report(products, daily):
+    """Собирает отчеты (товары, по дням). Синхронная, вызывается в отдельном потоке."""
+    products_csv = to_csv(
+        ['Тип', 'ID', 'Название', 'Просмотры', 'Смотрели', 'Покупки', 'Купили',
+         'Конверсия, %', 'Выручка, звезды', 'Выручка, карта'],
+        [
+            [DATA_NAMES.get(row.data_type, row.data_type), row.item_id, row.item_name, row.views, row.viewers,
+             row.purchases, row.buyers, conversion(row.buyers, row.viewers), row.revenue_stars, row.revenue_card]
+            for row in products
+        ]
+    )
+    daily_csv = to_csv(
+        ['День', 'Тип', 'Просмотры', 'Покупки'],
+        [[row.day, DATA_NAMES.get(row.data_type, row.data_type), row.views, row.purchases] for row in daily]
+    )
+    return products_csv, daily_csv
+
+
+def summary_text(products):
+    viewers = sum(row.viewers for row in products)
+    buyers = sum(row.buyers for row in products)
+    return (
+        f"Товаров с активностью: {len(products)}\n"
+        f"Просмотров: {sum(row.views for row in products)}, покупок: {sum(row.purchases for row in products)}\n"
+        f"Конверсия просмотр → оплата: {conversion(buyers, viewers) or 0}%\n"
+        f"Выручка: {sum(row.revenue_stars for row in products)}⭐, {sum(row.revenue_card for row in products)}₽"
+    )
 
 
 @router.callback_query(F.data.startswith('keyboardstatistika'))
@@ -41,24 +69,63 @@ async def statistica(callback: CallbackQuery, bot: Bot):
     try:
         await callback.message.answer("Отправляю файлы статистики...")
 
-        # Convert JSON to TXT
-        gaid_converted = await convert_json_to_txt(GAID_DATA_JSON, GAID_DATA_TXT)
-        kurs_converted = await convert_json_to_txt(KURS_DATA_JSON, KURS_DATA_TXT)
+        products = await rq.get_product_stats()
+        if not products:
+            await callback.message.answer("Статистики пока нет: товары еще никто не смотрел.")
+            return
+        daily = await rq.get_daily_stats(DAILY_DAYS)
+        products_csv, daily_csv = await asyncio.to_thread(build_report, products, daily)
 
         try:
-            if gaid_converted and os.path.exists(GAID_DATA_TXT):
-                gaid_data_file = FSInputFile(GAID_DATA_TXT)
-                await bot.send_document(chat_id=chat_id, document=gaid_data_file)
-            else:
-                await callback.message.answer( f"Файл {GAID_DATA_JSON} не найден или не удалось его преобразовать.")
-
-            if kurs_converted and os.path.exists(KURS_DATA_TXT):
-                kurs_date_file = FSInputFile(KURS_DATA_TXT)
-                await bot.send_document(chat_id=chat_id, document=kurs_date_file)
-            else:
-                await callback.message.answer(f"Файл {KURS_DATA_JSON} не найден или не удалось его преобразовать.")
+            await callback.message.answer(summary_text(products))
+            await bot.send_document(chat_id=chat_id, document=BufferedInputFile(products_csv, filename='products.csv'))
+            await bot.send_document(
+                chat_id=chat_id,
+                document=BufferedInputFile(daily_csv, filename='daily.csv'),
+                caption=f"По дням за {DAILY_DAYS} дней"
+            )
         except Exception as e:
             await callback.message.answer(f"Произошла ошибка при отправке файлов: {e}")
     except Exception as e:
         print(f"Ошибка в статистике: {e}")
 
+
+def funnel_text(totals: Counter, hours: int, snapshot) -> str:
+    by_stage = Counter()
+    by_product: dict[tuple[str, int], Counter] = {}
+    for (stage, data_type, item_id), count in totals.items():
+        by_stage[stage] += count
+        if item_id:
+            by_product.setdefault((data_type, item_id), Counter())[stage] += count
+
+    lines = [f"<b>Воронка за {hours} ч</b>"]
+    previous = None
+    for stage in STAGES:
+        count = by_stage[stage]
+        share = f" ({count / previous * 100:.0f}%)" if previous else ''
+        lines.append(f"{STAGE_NAMES[stage]}: {count}{share}")
+        previous = count
+
+    if by_product:
+        lines.append('')
+        product_stages = STAGES[2:]
+        lines.append(' → '.join(STAGE_NAMES[stage] for stage in product_stages) + ':')
+        ranked = sorted(by_product.items(), key=lambda pair: (-pair[1]['payment_confirmed'], -pair[1]['select']))
+        for (data_type, item_id), counts in ranked:
+            item = snapshot.by_id.get(data_type, {}).get(item_id)
+            name = html.quote(getattr(item, f'name_fail_{data_type}')) if item else f'#{item_id}'
+            lines.append(f"{DATA_NAMES.get(data_type, data_type)} {name}: "
+                         + ' → '.join(str(counts[stage]) for stage in product_stages))
+    return '\n'.join(lines)
+
+
+@router.message(Command(commands='funnel'))
+async def funnel_stats(message: Message, command: CommandObject):
+    """/funnel [часов] - живая воронка из счетчиков в памяти, по умолчанию за сутки."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer('Эта команда не для вас)')
+        return
+    hours = int(command.args) if command.args and command.args.isdigit() else 24
+    hours = max(1, min(hours, funnel.window_hours))
+    text = funnel_text(funnel.totals(hours), hours, await catalog.get())
+    await message.answer(f"{text}\n\nОтвет на pre_checkout с запуска:\n{pre_checkout_latency.summary()}")
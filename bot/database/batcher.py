@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBatcher:
+    """Копит записи в памяти и сбрасывает их в базу одной транзакцией.
+
+    Сброс происходит раз в interval секунд или сразу при накоплении max_size записей.
+    Если задан key, из записей с одинаковым ключом остается последняя.
+    Неудачная пачка не теряется, а возвращается в очередь.
+    """
+
+    def __init__(self, flush_func: Callable[[list], Awaitable[Any]], max_size: int = 500,
+                 interval: float = 0.5, key: Callable[[Any], Hashable] | None = None):
+        self.flush_func = flush_func
+        self.max_size = max_size
+        self.interval = interval
+        self.key = key
+        self.items: dict | list = {} if key else []
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+
+    def add(self, item):
+        if self.key:
+            self.items[self.key(item)] = item
+        else:
+            self.items.append(item)
+        if len(self.items) >= self.max_size:
+            self.full.set()
+
+    async def flush(self) -> bool:
+        """Пишет накопленное. Если запись не удалась, записи возвращаются в очередь до следующей попытки."""
+        async with self.lock:
+            if not self.items:
+                return True
+            batch = self.items
+            items = list(batch.values()) if self.key else batch
+            self.items = {} if self.key else []
+            self.full.clear()
+            try:
+                await self.flush_func(items)
+            except Exception as e:
+                logger.error(f"Не удалось записать пачку из {len(items)} записей, повторю позже: {e}")
+                # Более новые записи с тем же ключом, пришедшие во время записи, важнее вернувшихся
+                self.items = {**batch, **self.items} if self.key else batch + self.items
+                return False
+            return True
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            if not await self.flush():
+                # Не долбим базу повторами, даже если очередь уже переполнена
+                await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
@@ -0,0 +1,155 @@
+"""Нагрузочная проверка профилей движка SQLite: чтения каталога параллельно с записями рассылки.
+
+Короткие писатели - одиночные UPDATE с автокоммитом. Длинный писатель держит одну
+транзакцию на несколько больших порций INSERT с паузами между ними, как сброс пачки
+рассылки, и именно он без WAL блокирует читателей и ловит 'database is locked'.
+Задержки считаются только по успешным чтениям, неудачные видны в числе ошибок.
+
+Запуск из папки bot: python -m database.benchmark [--users 20000] [--seconds 10]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from collections import Counter
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database.models import Base, User, Gaid, Event, ENGINE_PROFILES, make_engine
+
+
+async def prepare(session_maker, users: int):
+    async with session_maker() as session:
+        session.add_all(User(tg_id=tg_id, tg_name=f'user{tg_id}', active=1) for tg_id in range(1, users + 1))
+        session.add_all(
+            Gaid(name_fail_gaid=f'gaid{i}', photo_gaid='photo', description_gaid='description',
+                 fail_gaid='file', price_card_gaid=100, price_star_gaid=50)
+            for i in range(30)
+        )
+        await session.commit()
+
+
+async def reader(session_maker, deadline: float, latencies: list[float], errors: list[str]):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            async with session_maker() as session:
+                result = await session.scalars(select(Gaid))
+                result.all()
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(f'чтение {type(e).__name__}')
+        await asyncio.sleep(0)
+
+
+async def writer(session_maker, deadline: float, users: int, writes: list[int], errors: list[str]):
+    tg_id = 1
+    while time.monotonic() < deadline:
+        chunk = list(range(tg_id, min(tg_id + 200, users + 1)))
+        tg_id = 1 if chunk[-1] >= users else chunk[-1] + 1
+        try:
+            async with session_maker() as session:
+                await session.execute(update(User).where(User.tg_id.in_(chunk)).values(active=tg_id % 2))
+                await session.commit()
+            writes.append(len(chunk))
+        except Exception as e:
+            errors.append(f'запись {type(e).__name__}')
+
+
+async def long_writer(session_maker, deadline: float, chunks: int, pause: float,
+                      writes: list[int], errors: list[str]):
+    """Одна транзакция на chunks порций по 2000 событий с паузой между ними, как сброс пачки рассылки.
+
+    Пачка больше кэша страниц SQLite по умолчанию, поэтому без WAL писатель берет
+    эксклюзивную блокировку еще до commit и держит ее на все паузы.
+    """
+    while time.monotonic() < deadline:
+        rows = 0
+        try:
+            async with session_maker() as session:
+                for _ in range(chunks):
+                    await session.execute(insert(Event), [
+                        {'kind': 'view', 'data_type': 'gaid', 'item_id': i % 30, 'item_name': f'gaid{i % 30}',
+                         'tg_id': i, 'tg_name': f'user{i}' * 4, 'method': None, 'amount': None}
+                        for i in range(2000)
+                    ])
+                    rows += 2000
+                    await asyncio.sleep(pause)
+                await session.commit()
+            writes.append(rows)
+        except Exception as e:
+            errors.append(f'запись {type(e).__name__}')
+
+
+async def run_profile(profile: str, users: int, seconds: float, readers: int, writers: int,
+                      long_writers: int, chunks: int, pause: float) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        engine = make_engine(f'sqlite+aiosqlite:///{os.path.join(directory, "bench.sqlite3")}', profile)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_maker = async_sessionmaker(engine)
+        await prepare(session_maker, users)
+
+        latencies: list[float] = []
+        writes: list[int] = []
+        errors: list[str] = []
+        deadline = time.monotonic() + seconds
+        await asyncio.gather(
+            *(reader(session_maker, deadline, latencies, errors) for _ in range(readers)),
+            *(writer(session_maker, deadline, users, writes, errors) for _ in range(writers)),
+            *(long_writer(session_maker, deadline, chunks, pause, writes, errors)
+              for _ in range(long_writers)),
+        )
+        await engine.dispose()
+
+    latencies.sort()
+    result = {
+        'profile': profile,
+        'reads': len(latencies) / seconds,
+        'p50': statistics.median(latencies) * 1000 if latencies else 0,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0,
+        'max': latencies[-1] * 1000 if latencies else 0,
+        'rows': sum(writes) / seconds,
+        'errors': errors,
+    }
+    print(
+        f"{profile:>8}: чтений {result['reads']:8.1f}/с  p50 {result['p50']:6.2f} мс  p99 {result['p99']:7.2f} мс  "
+        f"max {result['max']:7.1f} мс  записей {result['rows']:9.1f} строк/с  ошибок {len(errors)}"
+        + (f' ({", ".join(f"{name}: {count}" for name, count in sorted(Counter(errors).items()))})' if errors else '')
+    )
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--long-writers', type=int, default=1)
+    parser.add_argument('--chunks', type=int, default=10, help='порций INSERT в одной длинной транзакции')
+    parser.add_argument('--pause', type=float, default=0.01, help='пауза между порциями, с')
+    parser.add_argument('--profiles', nargs='+', default=list(ENGINE_PROFILES))
+    args = parser.parse_args()
+    results = [
+        await run_profile(profile, args.users, args.seconds, args.readers, args.writers,
+                          args.long_writers, args.chunks, args.pause)
+        for profile in args.profiles
+    ]
+    if len(results) > 1:
+        base = results[0]
+        print(f"\nОтносительно {base['profile']}:")
+        for result in results[1:]:
+            print(
+                f"{result['profile']:>8}: чтений x{result['reads'] / max(base['reads'], 0.001):.2f}  "
+                f"p99 x{result['p99'] / max(base['p99'], 0.001):.2f}  "
+                f"записей x{result['rows'] / max(base['rows'], 0.001):.2f}  "
+                f"ошибок {len(result['errors'])} против {len(base['errors'])}"
+            )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
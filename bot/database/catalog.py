@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+from sqlalchemy import select
+
+from database.models import async_session, Gaid, Kurs
+
+
+logger = logging.getLogger(__name__)
+
+MODELS = {'gaid': Gaid, 'kurs': Kurs}
+
+
+class CatalogSnapshot:
+    """Неизменяемый срез каталога: товары по порядку, по id и по названию."""
+
+    def __init__(self, version: int, items: dict[str, list]):
+        self.version = version
+        self.items = {data_type: tuple(rows) for data_type, rows in items.items()}
+        self.by_id = {data_type: {item.id: item for item in rows} for data_type, rows in items.items()}
+        self.by_name = {
+            data_type: {getattr(item, f'name_fail_{data_type}'): item for item in rows}
+            for data_type, rows in items.items()
+        }
+
+
+class Catalog:
+    """Кэш гайдов и курсов на весь процесс.
+
+    Каталог меняется редко, поэтому читается из базы целиком при старте и после
+    каждого изменения, а все запросы обслуживаются из памяти. Новый срез строится
+    рядом и подменяет старый одной операцией присваивания.
+    """
+
+    def __init__(self):
+        self.snapshot: CatalogSnapshot | None = None
+        self.lock = asyncio.Lock()
+
+    async def reload(self) -> CatalogSnapshot:
+        async with self.lock:
+            items = {}
+            async with async_session() as session:
+                for data_type, model in MODELS.items():
+                    result = await session.scalars(select(model).order_by(model.id))
+                    items[data_type] = result.all()
+            version = self.snapshot.version + 1 if self.snapshot else 1
+            self.snapshot = CatalogSnapshot(version, items)
+            logger.info(f"Каталог загружен, версия {version}: "
+                        + ", ".join(f"{data_type}={len(rows)}" for data_type, rows in items.items()))
+            return self.snapshot
+
+    async def get(self) -> CatalogSnapshot:
+        if self.snapshot is None:
+            return await self.reload()
+        return self.snapshot
+
+
+catalog = Catalog()
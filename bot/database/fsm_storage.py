@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert
+
+from database.batcher import WriteBehindBatcher
+from database.models import async_session, FsmRecord
+
+
+logger = logging.getLogger(__name__)
+
+# Незавершенные сценарии (добавление товара, проверка чека) живут трое суток с последнего изменения
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', 3 * 24 * 3600))
+FSM_SWEEP_INTERVAL = float(os.getenv('FSM_SWEEP_INTERVAL', 600))
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 5000))
+# Изменения одного ключа за это время сливаются в одну запись
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', 0.5))
+
+
+class CachedRecord:
+    __slots__ = ('state', 'data', 'expires_at')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None, expires_at: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.expires_at = expires_at
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в SQLite с TTL на ключ и кэшем чтений в памяти.
+
+    Источник правды - LRU-кэш: бот работает в одном процессе, и других писателей
+    у таблицы fsm_states нет. Изменения пишутся в таблицу не сразу, а через
+    WriteBehindBatcher по ключу: update_data и set_state одного клика дают одну
+    запись, а клики разных пользователей - одну транзакцию. Ключи, ждущие записи,
+    из кэша не вытесняются. При остановке несохраненное дописывается. Каждое
+    изменение продлевает срок записи, просроченные записи удаляет фоновая задача.
+    """
+
+    def __init__(self, ttl: float = FSM_STATE_TTL, sweep_interval: float = FSM_SWEEP_INTERVAL,
+                 cache_size: int = FSM_CACHE_SIZE, key_builder: KeyBuilder | None = None,
+                 flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.cache_size = cache_size
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self.cache: OrderedDict[str, CachedRecord] = OrderedDict()
+        self.saver = WriteBehindBatcher(self._write, interval=flush_interval, key=lambda row: row[0])
+        self.writing: set[str] = set()
+        self.sweeper: asyncio.Task | None = None
+
+    def _unsaved(self, key: str) -> bool:
+        return key in self.saver.items or key in self.writing
+
+    def _remember(self, key: str, record: CachedRecord):
+        self.cache[key] = record
+        self.cache.move_to_end(key)
+        excess = len(self.cache) - self.cache_size
+        if excess > 0:
+            # Вытесняем самые старые, но не те, что еще не записаны в базу
+            victims = []
+            for old_key in self.cache:
+                if len(victims) >= excess:
+                    break
+                if not self._unsaved(old_key):
+                    victims.append(old_key)
+            for old_key in victims:
+                del self.cache[old_key]
+
+    async def _load(self, key: str) -> CachedRecord:
+        record = self.cache.get(key)
+        if record is not None:
+            self.cache.move_to_end(key)
+        else:
+            async with async_session() as session:
+                row = await session.get(FsmRecord, key)
+            record = CachedRecord(row.state, json.loads(row.data or '{}'), row.expires_at) if row else CachedRecord()
+            self._remember(key, record)
+        if record.expires_at and record.expires_at < time.time():
+            record = CachedRecord()
+            self._remember(key, record)
+        return record
+
+    def _save(self, key: str, record: CachedRecord):
+        if record.empty:
+            row = (key, None, None, 0.0)
+        else:
+            record.expires_at = time.time() + self.ttl
+            row = (key, record.state, json.dumps(record.data, ensure_ascii=False), record.expires_at)
+        self._remember(key, record)
+        self.saver.add(row)
+
+    async def _write(self, rows: list[tuple]):
+        """Пишет пачку изменений одной транзакцией: пустые записи удаляются, остальные - upsert."""
+        self.writing = {row[0] for row in rows}
+        try:
+            removed = [key for key, state, data, expires_at in rows if data is None]
+            changed = [
+                {'key': key, 'state': state, 'data': data, 'expires_at': expires_at}
+                for key, state, data, expires_at in rows if data is not None
+            ]
+            async with async_session() as session:
+                if removed:
+                    await session.execute(delete(FsmRecord).where(FsmRecord.key.in_(removed)))
+                if changed:
+                    statement = insert(FsmRecord)
+                    await session.execute(
+                        statement.on_conflict_do_update(
+                            index_elements=[FsmRecord.key],
+                            set_={column: statement.excluded[column] for column in ('state', 'data', 'expires_at')}
+                        ),
+                        changed
+                    )
+                await session.commit()
+        finally:
+            self.writing = set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        record = await self._load(storage_key)
+        record.state = state.state if isinstance(state, State) else state
+        self._save(storage_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self.key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self.key_builder.build(key)
+        record = await self._load(storage_key)
+        record.data = data.copy()
+        self._save(storage_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(self.key_builder.build(key))).data.copy()
+
+    async def sweep(self) -> int:
+        """Удаляет просроченные записи из базы и кэша, возвращает их число в базе."""
+        now = time.time()
+        for key in [key for key, record in self.cache.items() if record.expires_at and record.expires_at < now]:
+            del self.cache[key]
+        async with async_session() as session:
+            result = await session.execute(delete(FsmRecord).where(FsmRecord.expires_at < now))
+            await session.commit()
+        if result.rowcount:
+            logger.info(f"Удалено просроченных состояний FSM: {result.rowcount}")
+        return result.rowcount
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Не удалось очистить состояния FSM: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self):
+        self.saver.start()
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+        await self.saver.stop()
+        self.cache.clear()
@@ -1,9 +1,59 @@
-from sqlalchemy import BigInteger, String, Integer
+import logging
+import os
+
+from sqlalchemy import BigInteger, String, Integer, Float, Text, DateTime, ForeignKey, UniqueConstraint, Index, func, text, event
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 
-engine = create_async_engine(url='sqlite+aiosqlite:///data/dbvoronkaasyabot.sqlite3')
-# engine = create_async_engine(url='sqlite+aiosqlite:///dbvoronkaasyabot.sqlite3')
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///data/dbvoronkaasyabot.sqlite3')
+# DATABASE_URL = 'sqlite+aiosqlite:///dbvoronkaasyabot.sqlite3'
+
+# Профили движка SQLite. PRAGMA применяются к каждому новому соединению.
+# aiosqlite держит отдельный поток на соединение, а писатель в SQLite всегда один,
+# поэтому пул небольшой: несколько читателей параллельно с одним писателем.
+ENGINE_PROFILES = {
+    'default': {
+        'pragmas': {},
+        'pool': {},
+    },
+    'tuned': {
+        'pragmas': {
+            'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+            'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+            # Отрицательное значение - размер в КиБ
+            'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64000)),
+            'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+            'temp_store': 'MEMORY',
+            'foreign_keys': 'ON',
+        },
+        'pool': {
+            'pool_size': int(os.getenv('SQLITE_POOL_SIZE', 4)),
+            'max_overflow': int(os.getenv('SQLITE_MAX_OVERFLOW', 4)),
+            'pool_timeout': 30,
+        },
+    },
+}
+
+
+def make_engine(url: str = DATABASE_URL, profile: str = os.getenv('SQLITE_PROFILE', 'tuned')):
+    settings = ENGINE_PROFILES[profile]
+    new_engine = create_async_engine(url=url, **settings['pool'])
+    pragmas = settings['pragmas']
+
+    if pragmas:
+        @event.listens_for(new_engine.sync_engine, 'connect')
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+
+    return new_engine
+
+
+engine = make_engine()
 
 async_session = async_sessionmaker(engine)
 
@@ -16,7 +66,7 @@ class User(Base):
     __tablename__ = 'users'
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    tg_id = mapped_column(BigInteger)
+    tg_id = mapped_column(BigInteger, index=True, unique=True)
     tg_name = mapped_column(String(35))
     active = mapped_column(Integer, default=1)
 
@@ -26,7 +76,7 @@ class Gaid(Base):
     __tablename__ = 'gaid'
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    name_fail_gaid = mapped_column(String(70))
+    name_fail_gaid = mapped_column(String(70), index=True, unique=True)
     photo_gaid = mapped_column(String(300))
     description_gaid = mapped_column(String(300))
     fail_gaid = mapped_column(String(300))
@@ -38,7 +88,7 @@ class Kurs(Base):
     __tablename__ = 'kurs'
 
     id: Mapped[int] = mapped_column(primary_key=True) 
-    name_fail_kurs = mapped_column(String(70))
+    name_fail_kurs = mapped_column(String(70), index=True, unique=True)
     photo_kurs = mapped_column(String(300))
     description_kurs = mapped_column(String(300))
     fail_kurs = mapped_column(String(300))
@@ -46,6 +96,151 @@ class Kurs(Base):
     price_star_kurs = mapped_column(Integer())
 
 
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind = mapped_column(String(20))
+    payload = mapped_column(Text)
+    admin_id = mapped_column(BigInteger)
+    status = mapped_column(String(20), default='preparing', index=True)
+    created_at = mapped_column(DateTime, server_default=func.now())
+
+
+class BroadcastRecipient(Base):
+    __tablename__ = 'broadcast_recipients'
+    __table_args__ = (UniqueConstraint('job_id', 'tg_id'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    job_id = mapped_column(ForeignKey('broadcast_jobs.id'))
+    tg_id = mapped_column(BigInteger)
+    status = mapped_column(String(10), default='pending')
+
+
+class Event(Base):
+    """Просмотры и покупки товаров: одна строка на событие."""
+    __tablename__ = 'events'
+    __table_args__ = (
+        Index('ix_events_product', 'data_type', 'item_id', 'kind'),
+        Index('ix_events_created_at', 'created_at'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind = mapped_column(String(10))  # select | purchase
+    data_type = mapped_column(String(10))
+    item_id = mapped_column(Integer)
+    # Название на момент события: товар могут удалить, а статистика должна остаться
+    item_name = mapped_column(String(70))
+    tg_id = mapped_column(BigInteger, index=True)
+    tg_name = mapped_column(String(130))
+    method = mapped_column(String(10), nullable=True)  # stars | card
+    amount = mapped_column(Integer, nullable=True)
+    created_at = mapped_column(DateTime, server_default=func.now())
+
+
+class FunnelCounter(Base):
+    """Счетчики воронки за час: сколько раз этап пройден для товара."""
+    __tablename__ = 'funnel_counters'
+    __table_args__ = (UniqueConstraint('hour', 'stage', 'data_type', 'item_id'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    hour = mapped_column(Integer)  # часов с начала эпохи, UTC
+    stage = mapped_column(String(20))
+    # Для этапов без товара (/start, открытие каталога) пустой тип и 0
+    data_type = mapped_column(String(10), default='')
+    item_id = mapped_column(Integer, default=0)
+    count = mapped_column(Integer, default=0)
+
+
+class FsmRecord(Base):
+    """Состояние FSM и его данные для одного ключа aiogram."""
+    __tablename__ = 'fsm_states'
+
+    key = mapped_column(String(200), primary_key=True)
+    state = mapped_column(String(100), nullable=True)
+    data = mapped_column(Text, default='{}')
+    expires_at = mapped_column(Float, index=True)  # time.time(), после которого запись не действует
+
+
+class ScheduledDeletion(Base):
+    """Сообщение, которое нужно удалить в момент delete_at."""
+    __tablename__ = 'scheduled_deletions'
+    __table_args__ = (UniqueConstraint('chat_id', 'message_id'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id = mapped_column(BigInteger)
+    message_id = mapped_column(BigInteger)
+    delete_at = mapped_column(Float, index=True)  # time.time()
+
+
+class Order(Base):
+    """Заказ товара.
+
+    Карта: pending -> confirmed -> delivered или pending -> rejected.
+    Звезды: confirmed -> delivered -> refunded.
+    """
+    __tablename__ = 'orders'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    tg_id = mapped_column(BigInteger, index=True)
+    tg_name = mapped_column(String(130))
+    data_type = mapped_column(String(10))
+    item_id = mapped_column(Integer)
+    item_name = mapped_column(String(70))
+    method = mapped_column(String(10))  # card | stars
+    amount = mapped_column(Integer)
+    receipt = mapped_column(String(300), nullable=True)  # file_id фото чека
+    # telegram_payment_charge_id оплаты звездами; уникален, чтобы повторный апдейт не создал второй заказ
+    charge_id = mapped_column(String(100), nullable=True, unique=True)
+    status = mapped_column(String(20), default='pending', index=True)
+    decided_by = mapped_column(BigInteger, nullable=True)
+    created_at = mapped_column(DateTime, server_default=func.now())
+
+
+class Delivery(Base):
+    """Отправка оплаченного файла: pending -> sending -> done, после всех попыток - dead."""
+    __tablename__ = 'deliveries'
+    __table_args__ = (Index('ix_deliveries_due', 'status', 'next_attempt_at'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    order_id = mapped_column(ForeignKey('orders.id'), unique=True)
+    tg_id = mapped_column(BigInteger)
+    data_type = mapped_column(String(10))
+    item_id = mapped_column(Integer)
+    status = mapped_column(String(10), default='pending')
+    attempts = mapped_column(Integer, default=0)
+    next_attempt_at = mapped_column(Float, default=0)  # time.time()
+    last_error = mapped_column(Text, nullable=True)
+    created_at = mapped_column(DateTime, server_default=func.now())
+
+
+logger = logging.getLogger(__name__)
+
+# Индексы, которые create_all не добавит в уже существующие таблицы: (имя, таблица, колонка)
+INDEXES = [
+    ('ix_users_tg_id', 'users', 'tg_id'),
+    ('ix_gaid_name_fail_gaid', 'gaid', 'name_fail_gaid'),
+    ('ix_kurs_name_fail_kurs', 'kurs', 'name_fail_kurs'),
+]
+
+
+async def migrate(conn):
+    """Добавляет уникальные индексы в существующую базу без потери данных."""
+    # Дубли пользователей - это один и тот же человек, оставляем первую запись
+    await conn.execute(text(
+        "DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY tg_id)"
+    ))
+    for name, table, column in INDEXES:
+        try:
+            async with conn.begin_nested():
+                await conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} ({column})"))
+        except IntegrityError:
+            # В каталоге есть одинаковые названия: удалять товары нельзя, ставим обычный индекс
+            logger.warning(f"В {table}.{column} есть дубли, создаю неуникальный индекс {name}")
+            await conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})"))
+
+
 async def async_main():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+        await migrate(conn)
\ No newline at end of file
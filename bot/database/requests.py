@@ -1,6 +1,10 @@
 from database.models import async_session
-from database.models import User, Gaid, Kurs
-from sqlalchemy import select, text
+from database.batcher import WriteBehindBatcher
+from database.catalog import catalog, MODELS as catalog_models
+from database.models import User, Gaid, Kurs, BroadcastJob, BroadcastRecipient, Event, FunnelCounter, ScheduledDeletion, Order, Delivery
+from sqlalchemy import select, update, delete, func, case, literal
+from sqlalchemy.dialects.sqlite import insert
+from datetime import datetime, timezone
 import logging
 
 
@@ -15,25 +19,341 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def upsert_user_statement():
+    statement = insert(User)
+    return statement.on_conflict_do_update(
+        index_elements=[User.tg_id],
+        set_={'tg_name': statement.excluded.tg_name, 'active': 1}
+    )
+
+
 async def set_user(tg_id, tg_name):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
+        await session.execute(upsert_user_statement().values(tg_id=tg_id, tg_name=tg_name, active=1))
+        await session.commit()
+
+
+async def set_users_bulk(users):
+    """Регистрирует пачку пользователей [(tg_id, tg_name)] одной транзакцией."""
+    async with async_session() as session:
+        await session.execute(
+            upsert_user_statement(),
+            [{'tg_id': tg_id, 'tg_name': tg_name, 'active': 1} for tg_id, tg_name in users]
+        )
+        await session.commit()
+
+
+# Регистрации с /start копятся и пишутся пачками, запускается в main.py
+user_batcher = WriteBehindBatcher(set_users_bulk, key=lambda user: user[0])
+
+
+def register_user(tg_id, tg_name):
+    user_batcher.add((tg_id, tg_name))
+
+
+async def add_events(events):
+    async with async_session() as session:
+        await session.execute(insert(Event), events)
+        await session.commit()
+
+
+# Просмотры и покупки пишутся пачками, запускается в main.py
+event_batcher = WriteBehindBatcher(add_events)
+
+
+def log_event(kind, data_type, item, tg_id, tg_name, method=None, amount=None):
+    """Ставит событие в очередь на запись, не дожидаясь базы."""
+    event_batcher.add({
+        'kind': kind,
+        'data_type': data_type,
+        'item_id': item.id,
+        'item_name': getattr(item, f'name_fail_{data_type}'),
+        'tg_id': tg_id,
+        'tg_name': tg_name,
+        'method': method,
+        'amount': amount,
+        # Время клика, а не записи пачки; в UTC, как и func.now() в SQLite
+        'created_at': datetime.now(timezone.utc).replace(tzinfo=None),
+    })
+
+
+async def add_funnel_counts(rows):
+    """Прибавляет приросты счетчиков воронки [{hour, stage, data_type, item_id, count}]."""
+    statement = insert(FunnelCounter)
+    statement = statement.on_conflict_do_update(
+        index_elements=[FunnelCounter.hour, FunnelCounter.stage, FunnelCounter.data_type, FunnelCounter.item_id],
+        set_={'count': FunnelCounter.count + statement.excluded.count}
+    )
+    async with async_session() as session:
+        await session.execute(statement, rows)
+        await session.commit()
+
+
+async def get_funnel_counts(since_hour):
+    async with async_session() as session:
+        result = await session.execute(
+            select(FunnelCounter.hour, FunnelCounter.stage, FunnelCounter.data_type,
+                   FunnelCounter.item_id, FunnelCounter.count)
+            .where(FunnelCounter.hour >= since_hour)
+        )
+        return result.all()
+
+
+def insert_delivery_statement():
+    return insert(Delivery).on_conflict_do_nothing(index_elements=[Delivery.order_id])
+
+
+def delivery_values(order_id, tg_id, data_type, item_id):
+    return {'order_id': order_id, 'tg_id': tg_id, 'data_type': data_type, 'item_id': item_id,
+            'status': 'pending', 'attempts': 0, 'next_attempt_at': 0}
+
+
+async def create_order(tg_id, tg_name, data_type, item, method, amount, receipt=None, charge_id=None,
+                       status='pending'):
+    """Создает заказ и возвращает его id, а для уже известного charge_id - None.
+
+    Оплаченный заказ (status='confirmed') получает выдачу в той же транзакции,
+    чтобы подтвержденный заказ не мог остаться без файла.
+    """
+    statement = insert(Order).values(
+        tg_id=tg_id, tg_name=tg_name, data_type=data_type, item_id=item.id,
+        item_name=getattr(item, f'name_fail_{data_type}'), method=method,
+        amount=amount, receipt=receipt, charge_id=charge_id, status=status
+    ).on_conflict_do_nothing(index_elements=[Order.charge_id])
+    async with async_session() as session:
+        result = await session.execute(statement)
+        if not result.rowcount:
+            return None
+        order_id = result.inserted_primary_key[0]
+        if status == 'confirmed':
+            await session.execute(insert_delivery_statement(), [delivery_values(order_id, tg_id, data_type, item.id)])
+        await session.commit()
+        return order_id
+
+
+async def get_order(order_id):
+    async with async_session() as session:
+        return await session.get(Order, order_id)
 
-        if not user:
-            session.add(User(tg_id=tg_id,tg_name=tg_name))
+
+async def set_order_status(order_id, from_status, to_status, admin_id=None):
+    """Переводит заказ из from_status в to_status. False, если заказ уже в другом статусе."""
+    values = {'status': to_status}
+    if admin_id is not None:
+        values['decided_by'] = admin_id
+    async with async_session() as session:
+        result = await session.execute(
+            update(Order).where(Order.id == order_id, Order.status == from_status).values(**values)
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def confirm_order_with_delivery(order_id, admin_id):
+    """Подтверждает заказ pending -> confirmed и ставит выдачу в очередь одной транзакцией.
+
+    False, если заказ уже обработан.
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            update(Order).where(Order.id == order_id, Order.status == 'pending')
+            .values(status='confirmed', decided_by=admin_id)
+        )
+        if result.rowcount != 1:
+            return False
+        order = await session.get(Order, order_id)
+        await session.execute(insert_delivery_statement(),
+                              [delivery_values(order.id, order.tg_id, order.data_type, order.item_id)])
+        await session.commit()
+        return True
+
+
+async def enqueue_missing_deliveries():
+    """Ставит в очередь выдачи подтвержденных заказов, у которых выдачи почему-то нет."""
+    missing = (
+        select(Order.id, Order.tg_id, Order.data_type, Order.item_id, literal('pending'), literal(0), literal(0))
+        .outerjoin(Delivery, Delivery.order_id == Order.id)
+        .where(Order.status == 'confirmed', Delivery.id.is_(None))
+    )
+    async with async_session() as session:
+        result = await session.execute(
+            insert_delivery_statement().from_select(
+                ['order_id', 'tg_id', 'data_type', 'item_id', 'status', 'attempts', 'next_attempt_at'], missing
+            )
+        )
+        await session.commit()
+        return result.rowcount
+
+
+async def claim_due_deliveries(now, limit):
+    """Забирает до limit выдач, чье время пришло, и помечает их 'sending'."""
+    async with async_session() as session:
+        # Строки, а не объекты: после commit объекты ORM истекают и без сессии не читаются
+        result = await session.execute(
+            select(Delivery.id, Delivery.order_id, Delivery.tg_id, Delivery.data_type,
+                   Delivery.item_id, Delivery.attempts)
+            .where(Delivery.status == 'pending', Delivery.next_attempt_at <= now)
+            .order_by(Delivery.next_attempt_at)
+            .limit(limit)
+        )
+        deliveries = result.all()
+        if deliveries:
+            await session.execute(
+                update(Delivery).where(Delivery.id.in_([delivery.id for delivery in deliveries])).values(status='sending')
+            )
             await session.commit()
+        return deliveries
 
 
-async def get_users():
+async def get_next_delivery_time():
     async with async_session() as session:
-        return await session.scalars(select(User))
+        return await session.scalar(select(func.min(Delivery.next_attempt_at)).where(Delivery.status == 'pending'))
+
+
+async def update_delivery(delivery_id, **values):
+    async with async_session() as session:
+        await session.execute(update(Delivery).where(Delivery.id == delivery_id).values(**values))
+        await session.commit()
+
+
+async def reset_sending_deliveries():
+    """После перезапуска выдачи, застрявшие в 'sending', снова ждут отправки."""
+    async with async_session() as session:
+        result = await session.execute(update(Delivery).where(Delivery.status == 'sending').values(status='pending'))
+        await session.commit()
+        return result.rowcount
+
+
+async def get_dead_deliveries(limit=20):
+    async with async_session() as session:
+        result = await session.execute(
+            select(Delivery, Order.tg_name, Order.item_name)
+            .join(Order, Order.id == Delivery.order_id)
+            .where(Delivery.status == 'dead')
+            .order_by(Delivery.id.desc())
+            .limit(limit)
+        )
+        return result.all()
+
+
+async def requeue_delivery(delivery_id):
+    """Возвращает выдачу из dead в очередь с обнуленными попытками."""
+    async with async_session() as session:
+        result = await session.execute(
+            update(Delivery).where(Delivery.id == delivery_id, Delivery.status == 'dead')
+            .values(status='pending', attempts=0, next_attempt_at=0)
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def add_scheduled_deletions(rows):
+    """Сохраняет отложенные удаления [(chat_id, message_id, delete_at)]."""
+    statement = insert(ScheduledDeletion)
+    statement = statement.on_conflict_do_update(
+        index_elements=[ScheduledDeletion.chat_id, ScheduledDeletion.message_id],
+        set_={'delete_at': statement.excluded.delete_at}
+    )
+    async with async_session() as session:
+        await session.execute(
+            statement,
+            [{'chat_id': chat_id, 'message_id': message_id, 'delete_at': delete_at}
+             for chat_id, message_id, delete_at in rows]
+        )
+        await session.commit()
+
+
+async def get_scheduled_deletions():
+    async with async_session() as session:
+        result = await session.execute(
+            select(ScheduledDeletion.chat_id, ScheduledDeletion.message_id, ScheduledDeletion.delete_at)
+        )
+        return result.all()
+
+
+async def remove_scheduled_deletions(chat_id, message_ids):
+    async with async_session() as session:
+        await session.execute(
+            delete(ScheduledDeletion)
+            .where(ScheduledDeletion.chat_id == chat_id, ScheduledDeletion.message_id.in_(message_ids))
+        )
+        await session.commit()
+
+
+def count_kind(kind, column=Event.id):
+    """COUNT(DISTINCT column) только по событиям вида kind."""
+    return func.count(func.distinct(case((Event.kind == kind, column))))
+
+
+def sum_revenue(method):
+    return func.coalesce(func.sum(case(((Event.kind == 'purchase') & (Event.method == method), Event.amount))), 0)
+
+
+async def get_product_stats():
+    """Просмотры, покупки и выручка по каждому товару, посчитанные в SQL."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(
+                Event.data_type,
+                Event.item_id,
+                func.max(Event.item_name).label('item_name'),
+                count_kind('select').label('views'),
+                count_kind('select', Event.tg_id).label('viewers'),
+                count_kind('purchase').label('purchases'),
+                count_kind('purchase', Event.tg_id).label('buyers'),
+                sum_revenue('stars').label('revenue_stars'),
+                sum_revenue('card').label('revenue_card'),
+            )
+            .group_by(Event.data_type, Event.item_id)
+            .order_by(Event.data_type, Event.item_id)
+        )
+        return result.all()
+
+
+async def get_daily_stats(days=30):
+    """Просмотры и покупки по дням за последние days дней: [(день, тип, просмотры, покупки)]."""
+    day = func.date(Event.created_at)
+    async with async_session() as session:
+        result = await session.execute(
+            select(
+                day.label('day'),
+                Event.data_type,
+                count_kind('select').label('views'),
+                count_kind('purchase').label('purchases'),
+            )
+            .where(Event.created_at >= func.datetime('now', f'-{int(days)} days'))
+            .group_by(day, Event.data_type)
+            .order_by(day, Event.data_type)
+        )
+        return result.all()
+
+
+async def iter_users(chunk_size=1000, only_active=False):
+    """Отдает пользователей порциями [(tg_id, active)] с пагинацией по ключу.
+
+    Каждая порция читается в своей короткой сессии, поэтому память и время
+    чтения не зависят от общего числа пользователей.
+    """
+    last_id = 0
+    while True:
+        async with async_session() as session:
+            query = select(User.id, User.tg_id, User.active).where(User.id > last_id)
+            if only_active:
+                query = query.where(User.active == 1)
+            result = await session.execute(query.order_by(User.id).limit(chunk_size))
+            rows = result.all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield [(row.tg_id, row.active) for row in rows]
     
 
-async def set_active(tg_id, active):
+async def set_active_bulk(tg_ids, active):
+    """Одним UPDATE ... WHERE tg_id IN (...) меняет флаг active у группы пользователей."""
+    if not tg_ids:
+        return
     async with async_session() as session:
-        newstate = text("UPDATE users SET active=:active WHERE tg_id=:tg_id")
-        newstate = newstate.bindparams(tg_id=tg_id, active=active)
-        await session.execute(newstate)
+        await session.execute(update(User).where(User.tg_id.in_(tg_ids)).values(active=active))
         await session.commit()
 
 
@@ -41,57 +361,196 @@ async def add_gaid(name_fail_gaid, photo_gaid, description_gaid, fail_gaid, pric
     async with async_session() as session:
         session.add(Gaid(name_fail_gaid=name_fail_gaid, photo_gaid=photo_gaid, description_gaid=description_gaid, fail_gaid=fail_gaid, price_card_gaid=price_card_gaid, price_star_gaid=price_star_gaid))
         await session.commit()
+    await catalog.reload()
 
     
 async def add_kurs(name_fail_kurs, photo_kurs, description_kurs, fail_kurs, price_card_kurs, price_star_kurs):
     async with async_session() as session:
         session.add(Kurs(name_fail_kurs=name_fail_kurs, photo_kurs=photo_kurs, description_kurs=description_kurs, fail_kurs=fail_kurs, price_card_kurs=price_card_kurs, price_star_kurs=price_star_kurs))
         await session.commit()
+    await catalog.reload()
 
 
-async def select_gaid():
+async def add_catalog_items(items):
+    """Добавляет пачку товаров одной транзакцией: [(data_type, {колонка: значение}), ...].
+
+    Возвращает id новых товаров в том же порядке. При ошибке не добавляется ничего.
+    """
+    async with async_session() as session:
+        rows = [catalog_models[data_type](**values) for data_type, values in items]
+        session.add_all(rows)
+        await session.flush()
+        ids = [row.id for row in rows]
+        await session.commit()
+    await catalog.reload()
+    return ids
+
+
+async def update_item_files(data_type, item_id, values):
+    """Обновляет file_id товара, например {'photo_gaid': ...}, и перечитывает каталог."""
+    model = catalog_models[data_type]
     async with async_session() as session:
-        return await session.scalars(select(Gaid))
+        await session.execute(update(model).where(model.id == item_id).values(**values))
+        await session.commit()
+    await catalog.reload()
+
+
+# Чтение каталога идет из кэша в памяти (database/catalog.py), без запросов к базе
+
+async def select_gaid():
+    return (await catalog.get()).items['gaid']
     
 
 async def select_kurs():
-    async with async_session() as session:
-        return await session.scalars(select(Kurs))
+    return (await catalog.get()).items['kurs']
     
 
 async def get_gaid(selection_id):
-    async with async_session() as session:
-        result = await session.scalars(select(Gaid).where(Gaid.name_fail_gaid == selection_id))
-        return result.all()
+    item = (await catalog.get()).by_name['gaid'].get(selection_id)
+    return [item] if item else []
     
 
 async def get_kurs(selection_id):
-    async with async_session() as session:
-        result = await session.scalars(select(Kurs).where(Kurs.name_fail_kurs == selection_id))
-        return result.all()
+    item = (await catalog.get()).by_name['kurs'].get(selection_id)
+    return [item] if item else []
     
 
+async def get_gaid_by_id(item_id):
+    item = (await catalog.get()).by_id['gaid'].get(item_id)
+    return [item] if item else []
+
+
+async def get_kurs_by_id(item_id):
+    item = (await catalog.get()).by_id['kurs'].get(item_id)
+    return [item] if item else []
+
+
 async def proverka_gaids():
-    async with async_session() as session:
-        return await session.scalar(select(Gaid.id))
+    items = (await catalog.get()).items['gaid']
+    return items[0].id if items else None
     
 
 async def proverka_kurss():
-    async with async_session() as session:
-        return await session.scalar(select(Kurs.id))
+    items = (await catalog.get()).items['kurs']
+    return items[0].id if items else None
     
 
-async def drop_table_gaid(selection_id):
+async def drop_table_gaid(item_id):
+    async with async_session() as session:
+        await session.execute(delete(Gaid).where(Gaid.id == item_id))
+        await session.commit()
+    await catalog.reload()
+
+
+async def drop_table_kurs(item_id):
+    async with async_session() as session:
+        await session.execute(delete(Kurs).where(Kurs.id == item_id))
+        await session.commit()
+    await catalog.reload()
+
+
+async def create_broadcast_job(kind, payload, admin_id):
+    """Создает рассылку в статусе 'preparing'. Если такая же рассылка уже идет, возвращает ее."""
+    async with async_session() as session:
+        job_id = await session.scalar(
+            select(BroadcastJob.id).where(BroadcastJob.status.in_(('preparing', 'running', 'paused')),
+                                          BroadcastJob.payload == payload)
+        )
+        if job_id is not None:
+            return job_id, False
+
+        job = BroadcastJob(kind=kind, payload=payload, admin_id=admin_id, status='preparing')
+        session.add(job)
+        await session.flush()
+        job_id = job.id
+        await session.commit()
+        return job_id, True
+
+
+async def add_broadcast_recipients(job_id, tg_ids):
+    if not tg_ids:
+        return
+    async with async_session() as session:
+        await session.execute(
+            insert(BroadcastRecipient).on_conflict_do_nothing(),
+            [{'job_id': job_id, 'tg_id': tg_id, 'status': 'pending'} for tg_id in tg_ids]
+        )
+        await session.commit()
+
+
+async def get_broadcast_job(job_id):
     async with async_session() as session:
-        namegaid = await session.scalars(select(Gaid).where(Gaid.name_fail_gaid == selection_id))
-        for gaid in namegaid:
-            await session.delete(gaid)
+        return await session.get(BroadcastJob, job_id)
+
+
+async def get_unfinished_broadcast_jobs():
+    async with async_session() as session:
+        result = await session.scalars(
+            select(BroadcastJob).where(BroadcastJob.status.in_(('preparing', 'running', 'paused')))
+        )
+        return result.all()
+
+
+async def claim_broadcast_recipients(job_id, limit, after_tg_id=0):
+    """Помечает порцию получателей с tg_id > after_tg_id как 'sending' и возвращает [(tg_id, active)].
+
+    Отметка ставится до отправки: после перезапуска такие получатели не отправляются повторно.
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(BroadcastRecipient.tg_id, func.coalesce(User.active, 1))
+            .outerjoin(User, User.tg_id == BroadcastRecipient.tg_id)
+            .where(BroadcastRecipient.job_id == job_id,
+                   BroadcastRecipient.tg_id > after_tg_id,
+                   BroadcastRecipient.status == 'pending')
+            .order_by(BroadcastRecipient.tg_id)
+            .limit(limit)
+        )
+        recipients = [tuple(row) for row in result]
+        if recipients:
+            await session.execute(
+                update(BroadcastRecipient)
+                .where(BroadcastRecipient.job_id == job_id,
+                       BroadcastRecipient.tg_id.in_([tg_id for tg_id, _ in recipients]))
+                .values(status='sending')
+            )
+            await session.commit()
+        return recipients
+
+
+async def set_broadcast_recipients_status(job_id, tg_ids, status):
+    async with async_session() as session:
+        await session.execute(
+            update(BroadcastRecipient)
+            .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.tg_id.in_(tg_ids))
+            .values(status=status)
+        )
         await session.commit()
 
 
-async def drop_table_kurs(selection_id):
+async def release_broadcast_recipients(job_id):
+    """Возвращает в 'pending' получателей, которых забрали ('sending'), но так и не отправили."""
+    async with async_session() as session:
+        result = await session.execute(
+            update(BroadcastRecipient)
+            .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == 'sending')
+            .values(status='pending')
+        )
+        await session.commit()
+        return result.rowcount
+
+
+async def get_broadcast_job_counts(job_id):
+    async with async_session() as session:
+        result = await session.execute(
+            select(BroadcastRecipient.status, func.count())
+            .where(BroadcastRecipient.job_id == job_id)
+            .group_by(BroadcastRecipient.status)
+        )
+        return dict(result.all())
+
+
+async def set_broadcast_job_status(job_id, status):
     async with async_session() as session:
-        namekurs = await session.scalars(select(Kurs).where(Kurs.name_fail_kurs == selection_id))
-        for kurs in namekurs:
-            await session.delete(kurs)
+        await session.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(status=status))
         await session.commit()
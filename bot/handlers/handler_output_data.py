@@ -2,13 +2,10 @@ import logging
 import json
 import os
 import time
-import asyncio
-import transliterate
 from datetime import datetime, timezone
 from logging.handlers import RotatingFileHandler
 
 from aiogram import F, Router, html, Bot
-from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery
 from aiogram.fsm.state import StatesGroup, State
@@ -17,6 +14,13 @@ from dotenv import load_dotenv
 
 import keyboards.keyboard as kb
 import database.requests as rq
+from utils.delivery import product_card, ADMIN_IDS, DATA_NAMES
+from utils.funnel import funnel
+from utils.metrics import LatencyStats
+from database.catalog import catalog
+from utils.scheduler import deletions
+from utils.delivery_queue import delivery_queue
+from utils.ratelimit import Lane, lane
 
 # Настройка логгера
 class JsonFormatter(logging.Formatter):
@@ -96,31 +100,6 @@ class UserSelectionStates(StatesGroup):
 class OutputDataHandler:
     def __init__(self, data_type: str):
         self.data_type = data_type
-        self.data_file = f"{data_type}_data.json"
-        
-    def transliterate_filename(self, filename):
-        """Транслитерирует имя файла с русского на английский."""
-        try:
-            return transliterate.translit(filename, 'ru', reversed=True)
-        except transliterate.exceptions.TranslitException:
-            logger.warning(f"Не удалось выполнить транслитерацию '{filename}'")
-            return filename
-    
-    def load_data(self):
-        """Загружает данные из JSON файла."""
-        if os.path.exists(self.data_file):
-            with open(self.data_file, "r", encoding='utf-8') as f:
-                try:
-                    return json.load(f)
-                except json.JSONDecodeError:
-                    logger.error(f"Ошибка декодирования JSON из {self.data_file}")
-                    return {}
-        return {}
-    
-    def save_data(self, data):
-        """Сохраняет данные в JSON файл."""
-        with open(self.data_file, "w", encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
     
     async def start(self, message: Message, bot: Bot):
         """Начало работы с данными."""
@@ -130,6 +109,7 @@ class OutputDataHandler:
             data_name = "гайд" if self.data_type == "gaid" else "курс"
             await bot.send_message(message.from_user.id, f'Пока {data_name}ов нет')
         else:
+            funnel.hit('catalog_open', self.data_type)
             keyboard_func = getattr(kb, f'selectkeyboard{self.data_type}')
             data_name = "гайд" if self.data_type == "gaid" else "курс"
             await bot.send_message(
@@ -138,7 +118,7 @@ class OutputDataHandler:
                 reply_markup=await keyboard_func()
             )
     
-    async def select(self, callback: CallbackQuery, state: FSMContext):
+    async def select(self, callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
         """Обработка выбора конкретного элемента."""
         await callback.answer('')
 
@@ -148,7 +128,7 @@ class OutputDataHandler:
 
         user_name = callback.from_user.full_name
         admin_id = os.getenv('ADMIN_ID')
-        selection_id = callback.data.split('_')[1] 
+        selection_id = callback_data.item_id
         
         # Сохранение выбранного элемента в состояние
         await state.update_data(
@@ -164,108 +144,90 @@ class OutputDataHandler:
         else:
             await state.set_state(UserSelectionStates.selected_kurs)
         
-        # Сохранение в JSON
-        data = self.load_data()
-        if str(user_name) not in data:
-            data[str(user_name)] = []
-        
-        get_func = getattr(rq, f'get_{self.data_type}')
+        get_func = getattr(rq, f'get_{self.data_type}_by_id')
         items = await get_func(selection_id)
         if not items:
-            await logger.error("Элемент не найден в базе данных")
+            logger.error("Элемент не найден в базе данных")
             return
         
         for item in items:
-            transliterated_name = self.transliterate_filename(
-                item.name_fail_gaid if self.data_type == 'gaid' else item.name_fail_kurs
-            )
-            
-            if transliterated_name not in data[str(user_name)]:
-                data[str(user_name)].append(transliterated_name)
+            rq.log_event('select', self.data_type, item, callback.from_user.id, user_name)
+            funnel.hit('select', self.data_type, item.id)
         
-        self.save_data(data)
-        
-        # Отправка информации о выбранном элементе
+        # Отправка карточки товара одним сообщением: обложка с описанием и ценами
         for item in items:
-            photo_field = getattr(item, f'photo_{self.data_type}')
-            name_field = getattr(item, f'name_fail_{self.data_type}')
-            description_field = getattr(item, f'description_{self.data_type}')
-            price_card_field = getattr(item, f'price_card_{self.data_type}')
-            price_star_field = getattr(item, f'price_star_{self.data_type}')
-            
-            await callback.message.answer_photo(photo_field)
-            await callback.message.answer(
-                f'{html.bold("Гайд:" if self.data_type == "gaid" else "Курс:")} {name_field}\n'
-                f'{html.bold("Описание:")} {description_field}\n'
-                f'{html.bold("Стоимость в рублях:")} {price_card_field}\n'
-                f'{html.bold("Стоимость в звездах:")} {price_star_field}',
-                reply_markup=getattr(kb, f'payment_keyboard_{self.data_type}')
+            await callback.message.answer_photo(
+                getattr(item, f'photo_{self.data_type}'),
+                caption=product_card(item, self.data_type),
+                reply_markup=kb.payment_keyboard(self.data_type, item.id)
             )
     
-    async def buy_with_stars(self, callback: CallbackQuery, state: FSMContext):
+    async def buy_with_stars(self, callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
         """Покупка с использованием звезд."""
-        data = await state.get_data()
-        selection_id = data.get('selection_id')
-        
-        if not selection_id:
-            await logger.error("Ошибка: не выбран элемент")
+        get_func = getattr(rq, f'get_{self.data_type}_by_id')
+        items = await get_func(callback_data.item_id)
+        if not items:
+            logger.error("Элемент не найден в базе данных")
+            await callback.answer('Этот товар больше не продается', show_alert=True)
             return
-            
-        get_func = getattr(rq, f'get_{self.data_type}')
-        items = await get_func(selection_id)
         
         for item in items:
             name_field = getattr(item, f'name_fail_{self.data_type}')
             description_field = getattr(item, f'description_{self.data_type}')
             price_star_field = getattr(item, f'price_star_{self.data_type}')
+            funnel.hit('payment_start', self.data_type, item.id)
             
             await callback.message.answer_invoice(
                 title=name_field,
                 description=description_field,
                 provider_token='',
                 currency="XTR",
-                payload=self.data_type,
+                payload=f"{self.data_type}:{item.id}",
                 prices=[LabeledPrice(label="XTR", amount=price_star_field)]
             )
         await callback.answer()
     
     async def successful_payment(self, message: Message, bot: Bot, state: FSMContext):
-        """Обработка успешной оплаты."""
-        data = await state.get_data()
-        selection_id = data.get('selection_id')
-        
-        if not selection_id:
-            await logger.error("Ошибка: не выбран элемент")
+        """Обработка успешной оплаты.
+
+        Товар берется из payload счета ("gaid:12"), а заказ создается по
+        telegram_payment_charge_id: повторный апдейт той же оплаты ничего не делает.
+        """
+        payment = message.successful_payment
+        _, _, item_id = payment.invoice_payload.partition(':')
+        get_func = getattr(rq, f'get_{self.data_type}_by_id')
+        items = await get_func(int(item_id)) if item_id.isdigit() else []
+        if not items:
+            logger.error(f"Оплачен неизвестный товар {payment.invoice_payload}, платеж {payment.telegram_payment_charge_id}")
+            await message.answer('Не нашли оплаченный товар, напишите администратору, мы во всем разберемся.')
             return
-            
-        get_func = getattr(rq, f'get_{self.data_type}')
-        items = await get_func(selection_id)
-        
-        for item in items:
-            file_field = getattr(item, f'fail_{self.data_type}')
-            await bot.send_document(
-                chat_id=message.from_user.id,
-                document=file_field,
-                caption=f"{'Гайд' if self.data_type == 'gaid' else 'Курс'}: {getattr(item, f'name_fail_{self.data_type}')}"
-            )
+        item = items[0]
 
-        await state.clear()    
-        logger.info(f"Состояние очищено после успешной оплаты для пользователя {message.from_user.id}")
+        order_id = await rq.create_order(
+            message.from_user.id, message.from_user.full_name, self.data_type, item, 'stars',
+            payment.total_amount, charge_id=payment.telegram_payment_charge_id, status='confirmed'
+        )
+        if order_id is None:
+            logger.info(f"Повторное уведомление об оплате {payment.telegram_payment_charge_id}, пропускаю")
+            return
+        # Выдача записана вместе с заказом; файл и возврат звезд - в очереди выдачи
+        delivery_queue.notify()
 
-        try:
-            await bot.refund_star_payment(
-                message.from_user.id,
-                message.successful_payment.telegram_payment_charge_id
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при возврате оплаты: {e}")
+        rq.log_event('purchase', self.data_type, item, message.from_user.id, message.from_user.full_name,
+                     method='stars', amount=payment.total_amount)
+        funnel.hit('payment_confirmed', self.data_type, item.id)
+
+        await state.clear()
+        logger.info(f"Состояние очищено после успешной оплаты для пользователя {message.from_user.id}")
     
-    async def pay_with_card(self, callback: CallbackQuery, state: FSMContext):
+    async def pay_with_card(self, callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
         """Обработка оплаты картой."""
         await callback.answer()
         
-        # Сохраняем текущие данные перед изменением состояния
-        await state.update_data(client_id=callback.from_user.id)
+        # Товар берем из кнопки: пользователь мог открыть другую карточку после этой
+        selection_id = callback_data.item_id
+        await state.update_data(client_id=callback.from_user.id, selection_id=selection_id, data_type=self.data_type)
+        funnel.hit('payment_start', self.data_type, selection_id)
         
         load_dotenv()
         phone = os.getenv('PHONE')
@@ -335,44 +297,23 @@ class OutputDataHandler:
             await message.answer('Прикрепите скриншот вашего чека по оплате пожалуйста')
             return
         
-        await bot.send_message(chat_id=user_id, text='Ожидайте подтверждение вашей оплаты админом')
-        
-        # Если admin_id не найден в состоянии, получаем из .env
-        if not admin_id:
-            load_dotenv()
-            admin_id = int(os.getenv('ADMIN_ID'))
-        
-        keyboard = getattr(kb, f'succsefull_keyboard_{self.data_type}')
-        
-        # Сохраняем необходимые данные для подтверждения
-        await state.update_data(
-            admin_message_data={
-                'client_id': user_id,
-                'selection_id': selection_id,
-                'data_type': self.data_type,
-                'photo': pay_photo_check,
-                'admin_id': admin_id 
-            }
-        )
-        
-        chekmessage = await bot.send_photo(
-            chat_id=admin_id,
-            caption='Проверьте оплату на корректность:',
-            photo=pay_photo_check,
-            reply_markup=keyboard
+        get_func = getattr(rq, f'get_{self.data_type}_by_id')
+        items = await get_func(selection_id) if selection_id else []
+        if not items:
+            await state.clear()
+            await message.answer('Товар не найден, выберите его заново')
+            return
+        item = items[0]
+
+        order_id = await rq.create_order(
+            user_id or message.from_user.id, data.get('user_name') or message.from_user.full_name,
+            self.data_type, item, 'card', getattr(item, f'price_card_{self.data_type}'), pay_photo_check
         )
-        
-        # Сохраняем ID сообщения для админа
-        await state.update_data(admin_message_id=chekmessage.message_id)
-        
-        logger.info(f"Фотография отправлена администратору {admin_id}")
-        
-        # Не очищаем состояние полностью, сохраняем необходимые данные
-        if self.data_type == 'gaid':
-            await state.set_state(CardPayStates.successful_photo_gaid)
-        else:
-            await state.set_state(CardPayStates.successful_photo_kurs)
-        
+        # Дальше заказ живет в базе, состояние покупателя больше не нужно
+        await state.clear()
+        await bot.send_message(chat_id=message.from_user.id, text='Ожидайте подтверждение вашей оплаты админом')
+        await send_order_to_admins(bot, await rq.get_order(order_id))
+        logger.info(f"Заказ {order_id} отправлен администраторам на проверку")
 
 
 # Создаем экземпляры обработчиков
@@ -385,29 +326,59 @@ kurs_handler = OutputDataHandler('kurs')
 async def gaid_start(message: Message, bot: Bot):
     await gaid_handler.start(message, bot)
 
-@router.callback_query(F.data.startswith('selectgaid_'))
+@router.callback_query(kb.CatalogItem.filter((F.action == 'select') & (F.data_type == 'gaid')))
 @log_user_action
-async def gaid_select(callback: CallbackQuery, state: FSMContext):
-    await gaid_handler.select(callback, state)
+async def gaid_select(callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
+    await gaid_handler.select(callback, state, callback_data)
 
-@router.callback_query(F.data.startswith('stars_gaid'))
+@router.callback_query(kb.CatalogItem.filter((F.action == 'stars') & (F.data_type == 'gaid')))
 @log_user_action
-async def buy_gaid(callback: CallbackQuery, state: FSMContext):
-    await gaid_handler.buy_with_stars(callback, state)
+async def buy_gaid(callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
+    await gaid_handler.buy_with_stars(callback, state, callback_data)
+
+# Telegram ждет ответа на pre_checkout_query 10 секунд, иначе покупка отменяется
+pre_checkout_latency = LatencyStats('pre_checkout')
+PRE_CHECKOUT_SLOW = 1.0
+
+
+def check_pre_checkout(event: PreCheckoutQuery) -> str | None:
+    """Проверяет счет по снимку каталога в памяти. Возвращает текст ошибки или None."""
+    data_type, _, item_id = event.invoice_payload.partition(':')
+    snapshot = catalog.snapshot
+    if snapshot is None or data_type not in snapshot.by_id or not item_id.isdigit():
+        return 'Не удалось найти товар, попробуйте выбрать его заново.'
+    item = snapshot.by_id[data_type].get(int(item_id))
+    if item is None:
+        return 'Этот товар больше не продается.'
+    if event.currency != 'XTR':
+        return 'Оплата принимается только в звездах.'
+    if event.total_amount != getattr(item, f'price_star_{data_type}'):
+        return 'Цена товара изменилась, откройте каталог и выберите товар заново.'
+    return None
+
 
 @router.pre_checkout_query()
 async def pre_checkout_query_gaid(event: PreCheckoutQuery) -> None:
-    await event.answer(ok=True)
-
-@router.message(F.successful_payment.invoice_payload == 'gaid')
+    # До answer никаких запросов в базу и к Bot API; сам answer не ждет лимита рассылки (UNLIMITED_METHODS)
+    started = time.perf_counter()
+    error = check_pre_checkout(event)
+    await event.answer(ok=error is None, error_message=error)
+    elapsed = time.perf_counter() - started
+    pre_checkout_latency.observe(elapsed)
+    if error:
+        logger.warning(f"Отклонен pre_checkout {event.invoice_payload} на {event.total_amount} {event.currency}: {error}")
+    if elapsed > PRE_CHECKOUT_SLOW:
+        logger.warning(f"Медленный ответ на pre_checkout: {elapsed * 1000:.0f} мс")
+
+@router.message(F.successful_payment.invoice_payload.startswith('gaid:'))
 @log_user_action
 async def successful_payment_gaid(message: Message, bot: Bot, state: FSMContext):
     await gaid_handler.successful_payment(message, bot, state)
 
-@router.callback_query(F.data.startswith('cards_gaid'))
+@router.callback_query(kb.CatalogItem.filter((F.action == 'card') & (F.data_type == 'gaid')))
 @log_user_action
-async def pay_photo_check_get_gaid(callback: CallbackQuery, state: FSMContext):
-    await gaid_handler.pay_with_card(callback, state)
+async def pay_photo_check_get_gaid(callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
+    await gaid_handler.pay_with_card(callback, state, callback_data)
 
 @router.message(CardPayStates.successful_photo_gaid)
 @log_user_action
@@ -420,240 +391,190 @@ async def successful_photo_gaid(message: Message, state: FSMContext, bot: Bot):
 async def kurs_start(message: Message, bot: Bot):
     await kurs_handler.start(message, bot)
 
-@router.callback_query(F.data.startswith('selectkurs_'))
+@router.callback_query(kb.CatalogItem.filter((F.action == 'select') & (F.data_type == 'kurs')))
 @log_user_action
-async def kurs_select(callback: CallbackQuery, state: FSMContext):
-    await kurs_handler.select(callback, state)
+async def kurs_select(callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
+    await kurs_handler.select(callback, state, callback_data)
 
-@router.callback_query(F.data.startswith('stars_kurs'))
+@router.callback_query(kb.CatalogItem.filter((F.action == 'stars') & (F.data_type == 'kurs')))
 @log_user_action
-async def buy_kurs(callback: CallbackQuery, state: FSMContext):
-    await kurs_handler.buy_with_stars(callback, state)
+async def buy_kurs(callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
+    await kurs_handler.buy_with_stars(callback, state, callback_data)
 
-@router.message(F.successful_payment.invoice_payload == 'kurs')
+@router.message(F.successful_payment.invoice_payload.startswith('kurs:'))
 @log_user_action
 async def successful_payment_kurs(message: Message, bot: Bot, state: FSMContext):
     await kurs_handler.successful_payment(message, bot, state)
 
-@router.callback_query(F.data.startswith('cards_kurs'))
+@router.callback_query(kb.CatalogItem.filter((F.action == 'card') & (F.data_type == 'kurs')))
 @log_user_action
-async def pay_photo_check_get_kurs(callback: CallbackQuery, state: FSMContext):
-    await kurs_handler.pay_with_card(callback, state)
+async def pay_photo_check_get_kurs(callback: CallbackQuery, state: FSMContext, callback_data: kb.CatalogItem):
+    await kurs_handler.pay_with_card(callback, state, callback_data)
 
 @router.message(CardPayStates.successful_photo_kurs)
 @log_user_action
 async def successful_photo_kurs(message: Message, state: FSMContext, bot: Bot):
     await kurs_handler.process_payment_photo(message, state, bot)
 
-# Обработчики подтверждения оплаты (остаются без изменений)
-@router.callback_query(F.data.startswith('true_gaid'))
-@log_user_action
-async def Trueanswer(callback: CallbackQuery):
-    await callback.answer()
-    chekkeyboard = await callback.message.answer('Вы точно все внимательно проверили?', reply_markup=kb.confirmation_gaid)
-    await asyncio.sleep(900)
-    await chekkeyboard.delete()
+# Сообщения админу при проверке оплаты удаляются через 15 минут
+ADMIN_MESSAGE_TTL = 900
 
-@router.callback_query(F.data.startswith('false_gaid'))
-@log_user_action
-async def Falseanswer(callback: CallbackQuery):
-    await callback.answer()
-    chekkeyboard = await callback.message.answer('Вы точно все внимательно проверили?', reply_markup=kb.confirmation_false_gaid)
-    await asyncio.sleep(900)
-    await chekkeyboard.delete()
 
-@router.callback_query(F.data.startswith('yes_false_gaid'))
-@log_user_action
-async def Confirmanswer(callback: CallbackQuery, bot: Bot, state: FSMContext):
-    data = await state.get_data()
-    admin_data = data.get('admin_message_data', {})
-    client_id = admin_data.get('client_id')
-    await callback.answer()
-    await state.clear()
-    logger.info(f"Состояние очищено перед сообщением пользователю о неккоректности платежа  для {client_id}")
-    falsecheck = await callback.message.answer('Понял вас! Сообщаю о неккоректности платежа пользователю!')
-    await bot.send_message(chat_id=client_id, text='Админ не подтвердил ваш платеж! Перепроверьте оплату!')
-    await asyncio.sleep(900)
-    await falsecheck.delete()
+def order_caption(order):
+    return (
+        f"Проверьте оплату на корректность:\n\n"
+        f"Заказ №{order.id}: {DATA_NAMES[order.data_type].lower()} «{html.quote(order.item_name)}», "
+        f"{order.amount}₽\nПокупатель: {html.quote(order.tg_name or '')} (<code>{order.tg_id}</code>)"
+    )
 
 
-@router.callback_query(F.data.startswith('no_false_gaid'))
-@log_user_action
-async def UnConfirmanswer(callback: CallbackQuery, bot: Bot, state: FSMContext):
-    data = await state.get_data()
-    admin_data = data.get('admin_message_data', {})
-    admin = admin_data.get('admin_id')
-    photo = admin_data.get('photo')
+async def send_order_review(bot: Bot, chat_id, order):
+    with lane(Lane.ADMIN):
+        return await bot.send_photo(
+            chat_id=chat_id,
+            caption=order_caption(order),
+            photo=order.receipt,
+            reply_markup=kb.order_review_keyboard(order.id, order.data_type)
+        )
 
-    if not admin or not photo:
-        load_dotenv()
-        admin = int(os.getenv('ADMIN_ID'))
-        if not photo:
-            photo = data.get('pay_photo_check')
 
+async def send_order_to_admins(bot: Bot, order):
+    """Чек уходит всем админам сразу, решение принимает тот, кто нажмет первым."""
+    for admin_id in ADMIN_IDS:
+        try:
+            await send_order_review(bot, admin_id, order)
+        except Exception as e:
+            logger.error(f"Не удалось отправить заказ {order.id} админу {admin_id}: {e}")
+
+
+async def get_pending_order(callback: CallbackQuery, order_id):
+    order = await rq.get_order(order_id)
+    if order is None:
+        await callback.answer('Заказ не найден')
+        return None
+    if order.status != 'pending':
+        await callback.answer(f'Заказ №{order.id} уже обработан')
+        return None
+    return order
+
+
+async def ask_review_confirmation(callback: CallbackQuery, callback_data: kb.OrderReview, keyboard_func):
+    order = await get_pending_order(callback, callback_data.order_id)
+    if order is None:
+        return
     await callback.answer()
-    chekmessage = await bot.send_photo(chat_id=admin, caption='Проверьте оплату на корректность:', photo=photo, reply_markup=kb.succsefull_keyboard_gaid)
-    await asyncio.sleep(900)
-    await chekmessage.delete()
+    chekkeyboard = await callback.message.answer(
+        f'Заказ №{order.id}. Вы точно все внимательно проверили?',
+        reply_markup=keyboard_func(order.id, order.data_type)
+    )
+    deletions.schedule(chekkeyboard, ADMIN_MESSAGE_TTL)
 
-@router.callback_query(F.data.startswith('ok_gaid'))
-@log_user_action
-async def ConfirmanswerYes(callback: CallbackQuery, bot: Bot, state: FSMContext):
-    data = await state.get_data()
-    admin_data = data.get('admin_message_data', {})
-    client_id = admin_data.get('client_id')
-    selection_id = admin_data.get('selection_id')
-    
-    if not client_id or not selection_id:
-        await callback.answer("Данные не найдены")
+
+async def review_again(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    order = await get_pending_order(callback, callback_data.order_id)
+    if order is None:
         return
-        
-    await state.clear()
-    logger.info(f"Состояние очищено перед отправкой гайда для {client_id}")
+    await callback.answer()
+    chekmessage = await send_order_review(bot, callback.from_user.id, order)
+    deletions.schedule(chekmessage, ADMIN_MESSAGE_TTL)
 
-    gaidsel = await rq.get_gaid(selection_id)
+
+async def approve_order(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    # Смена статуса одним UPDATE ... WHERE status='pending': второй клик или второй админ сюда не пройдут.
+    # Выдача пишется в той же транзакции, файл отправит очередь выдачи, с повторами
+    if not await rq.confirm_order_with_delivery(callback_data.order_id, callback.from_user.id):
+        await callback.answer('Заказ уже обработан')
+        return
+    delivery_queue.notify()
     await callback.answer()
-    try:
-        sendmessageg = await callback.message.answer('Отправляю гайд счастливчику🥳')
-        for gaid in gaidsel:
-            await bot.send_document(
-                chat_id=client_id,
-                document=gaid.fail_gaid,
-                caption=f"Гайд: {gaid.name_fail_gaid}"
-            )
-        logger.info(f"Гайд доставлен {client_id}")
-    except TelegramBadRequest as e:
-        await callback.message.answer('Гайд не отправился...\nОшибка уже отправлена Тех.Админу! Не переживайте, работы уже ведутся!')
-        await bot.send_message(chat_id=client_id, text="Не удалось отправить вам гайд. Мы работаем уже над этой проблемой. Обязательно вам пришлем гайд, как решим данную ошибку. Приносим свои извинения, за предоставленные неудобства!")
-        logger.error(f'Не удалось отправить гайд: {e}')
-    await asyncio.sleep(900)
-    await sendmessageg.delete()
+    order = await rq.get_order(callback_data.order_id)
+    data_name = DATA_NAMES[order.data_type]
+    logger.info(f"Заказ {order.id} подтвержден админом {callback.from_user.id}")
 
+    get_func = getattr(rq, f'get_{order.data_type}_by_id')
+    for item in await get_func(order.item_id):
+        rq.log_event('purchase', order.data_type, item, order.tg_id, order.tg_name,
+                     method='card', amount=order.amount)
+    funnel.hit('payment_confirmed', order.data_type, order.item_id)
 
-@router.callback_query(F.data.startswith('no_gaid'))
-@log_user_action
-async def UnConfirmanswerno(callback: CallbackQuery, bot: Bot, state: FSMContext):
-    data = await state.get_data()
-    admin_data = data.get('admin_message_data', {})
-    admin = admin_data.get('admin_id')
-    photo = admin_data.get('photo')
+    # О неудаче выдачи админы узнают из очереди выдачи
+    sendmessage = await callback.message.answer(f'Заказ №{order.id}. Отправляю {data_name.lower()} счастливчику🥳')
+    deletions.schedule(sendmessage, ADMIN_MESSAGE_TTL)
 
-    if not admin or not photo:
-        load_dotenv()
-        admin = int(os.getenv('ADMIN_ID'))
-        if not photo:
-            photo = data.get('pay_photo_check')
 
+async def reject_order(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    if not await rq.set_order_status(callback_data.order_id, 'pending', 'rejected', callback.from_user.id):
+        await callback.answer('Заказ уже обработан')
+        return
     await callback.answer()
-    chekmessage = await bot.send_photo(chat_id=admin, caption='Проверьте оплату на корректность:', photo=photo, reply_markup=kb.succsefull_keyboard_gaid)
-    await asyncio.sleep(900)
-    await chekmessage.delete()
+    order = await rq.get_order(callback_data.order_id)
+    logger.info(f"Заказ {order.id} отклонен админом {callback.from_user.id}")
+    falsecheck = await callback.message.answer(f'Заказ №{order.id}. Понял вас! Сообщаю о неккоректности платежа пользователю!')
+    deletions.schedule(falsecheck, ADMIN_MESSAGE_TTL)
+    await bot.send_message(chat_id=order.tg_id, text='Админ не подтвердил ваш платеж! Перепроверьте оплату!')
 
 
-@router.callback_query(F.data.startswith('true_kurs'))
+# Обработчики проверки оплаты: заказ берется из callback_data, а не из состояния админа
+@router.callback_query(kb.OrderReview.filter((F.action == 'approve') & (F.data_type == 'gaid')))
 @log_user_action
-async def Trueanswerkurs(callback: CallbackQuery):
-    await callback.answer()
-    chekkeyboardtrue = await callback.message.answer('Вы точно все внимательно проверили?', reply_markup=kb.confirmation_kurs)
-    await asyncio.sleep(900)
-    await chekkeyboardtrue.delete()
+async def Trueanswer(callback: CallbackQuery, callback_data: kb.OrderReview):
+    await ask_review_confirmation(callback, callback_data, kb.order_approve_keyboard)
 
-
-@router.callback_query(F.data.startswith('ok_kurs'))
+@router.callback_query(kb.OrderReview.filter((F.action == 'reject') & (F.data_type == 'gaid')))
 @log_user_action
-async def ConfirmanswerYeskurs(callback: CallbackQuery, bot: Bot, state: FSMContext):
-    data = await state.get_data()
-    admin_data = data.get('admin_message_data', {})
-    client_id = admin_data.get('client_id')
-    selection_id = admin_data.get('selection_id')
-    
-    if not client_id or not selection_id:
-        await callback.answer("Данные не найдены")
-        return
-    
-    await callback.answer()
-    await state.clear()
-    logger.info(f"Состояние очищено перед отправкой курса для {client_id}")
-    kurssel = await rq.get_kurs(selection_id)
-    try:
-        sendmessagek = await callback.message.answer('Отправляю курс счастливчику🥳')
-        for kurs in kurssel:
-            await bot.send_document(
-                chat_id=client_id,
-                document=kurs.fail_kurs,
-                caption=f"Курс: {kurs.name_fail_kurs}"
-            )
-        logger.info(f"Курс доставлен {client_id}")
-    except TelegramBadRequest as e:
-        sendmessageerror = await callback.message.answer('Курс не отправился...\nОшибка уже отправлена Тех.Админу! Не переживайте, работы уже ведутся!')
-        await bot.send_message(chat_id=client_id, text="Не удалось отправить вам курс. Мы работаем уже над этой проблемой. Обязательно вам пришлем курс, как решим данную ошибку. Приносим свои извинения, за предоставленные неудобства!")
-        print(f'Не удалось отправить курс: {e} -> Походу опять file_id устарел...\nАйди клиента:{client_id}\nНазвание товара:{kurs.name_fail_kurs}\nЕго товар:{kurs.fail_kurs}')
-    await asyncio.sleep(900)
-    await sendmessagek.delete()
-    await sendmessageerror.delete()
-    await state.clear()
-
-@router.callback_query(F.data.startswith('false_kurs'))
+async def Falseanswer(callback: CallbackQuery, callback_data: kb.OrderReview):
+    await ask_review_confirmation(callback, callback_data, kb.order_reject_keyboard)
+
+@router.callback_query(kb.OrderReview.filter((F.action == 'reject_yes') & (F.data_type == 'gaid')))
 @log_user_action
-async def Falseanswerkurs(callback: CallbackQuery):
-    await callback.answer()
-    chekkeyboardfalse = await callback.message.answer('Вы точно все внимательно проверили?', reply_markup=kb.confirmation_false_kurs)
-    await asyncio.sleep(900)
-    await chekkeyboardfalse.delete()
+async def Confirmanswer(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    await reject_order(callback, bot, callback_data)
 
-@router.callback_query(F.data.startswith('yes_false_kurs'))
+@router.callback_query(kb.OrderReview.filter((F.action == 'reject_no') & (F.data_type == 'gaid')))
 @log_user_action
-async def Confirmanswerkurs(callback: CallbackQuery, bot: Bot, state: FSMContext):
-    data = await state.get_data()
-    admin_data = data.get('admin_message_data', {})
-    client_id = admin_data.get('client_id')
-    await callback.answer()
-    await state.clear()
-    logger.info(f"Состояние очищено перед сообщением пользователю о неккоректности платежа  для {client_id}")
-    falsecheckyesfalse = await callback.message.answer('Понял вас! Сообщаю о неккоректности платежа пользователю!')
-    await bot.send_message(chat_id=client_id, text='Админ не подтвердил ваш платеж! Перепроверьте оплату!')
-    await asyncio.sleep(900)
-    await falsecheckyesfalse.delete()
+async def UnConfirmanswer(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    await review_again(callback, bot, callback_data)
 
+@router.callback_query(kb.OrderReview.filter((F.action == 'approve_yes') & (F.data_type == 'gaid')))
+@log_user_action
+async def ConfirmanswerYes(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    await approve_order(callback, bot, callback_data)
 
-@router.callback_query(F.data.startswith('no_false_kurs'))
+@router.callback_query(kb.OrderReview.filter((F.action == 'approve_no') & (F.data_type == 'gaid')))
 @log_user_action
-async def UnConfirmanswerkurs(callback: CallbackQuery, bot: Bot, state: FSMContext):
-    data = await state.get_data()
-    admin_data = data.get('admin_message_data', {})
-    admin = admin_data.get('admin_id')
-    photo = admin_data.get('photo')
+async def UnConfirmanswerno(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    await review_again(callback, bot, callback_data)
 
-    if not admin or not photo:
-        load_dotenv()
-        admin = int(os.getenv('ADMIN_ID'))
-        if not photo:
-            photo = data.get('pay_photo_check')
 
-    await callback.answer()
-    chekmessagenofalse = await bot.send_photo(chat_id=admin, caption='Проверьте оплату на корректность:', photo=photo, reply_markup=kb.succsefull_keyboard_kurs)
-    await asyncio.sleep(900)
-    await chekmessagenofalse.delete()
+@router.callback_query(kb.OrderReview.filter((F.action == 'approve') & (F.data_type == 'kurs')))
+@log_user_action
+async def Trueanswerkurs(callback: CallbackQuery, callback_data: kb.OrderReview):
+    await ask_review_confirmation(callback, callback_data, kb.order_approve_keyboard)
 
+@router.callback_query(kb.OrderReview.filter((F.action == 'approve_yes') & (F.data_type == 'kurs')))
+@log_user_action
+async def ConfirmanswerYeskurs(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    await approve_order(callback, bot, callback_data)
 
-@router.callback_query(F.data.startswith('no_kurs'))
+@router.callback_query(kb.OrderReview.filter((F.action == 'reject') & (F.data_type == 'kurs')))
 @log_user_action
-async def UnConfirmanswernokurs(callback: CallbackQuery, bot: Bot, state: FSMContext):
-    data = await state.get_data()
-    admin_data = data.get('admin_message_data', {})
-    admin = admin_data.get('admin_id')
-    photo = admin_data.get('photo')
+async def Falseanswerkurs(callback: CallbackQuery, callback_data: kb.OrderReview):
+    await ask_review_confirmation(callback, callback_data, kb.order_reject_keyboard)
 
-    if not admin or not photo:
-        load_dotenv()
-        admin = int(os.getenv('ADMIN_ID'))
-        if not photo:
-            photo = data.get('pay_photo_check')
+@router.callback_query(kb.OrderReview.filter((F.action == 'reject_yes') & (F.data_type == 'kurs')))
+@log_user_action
+async def Confirmanswerkurs(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    await reject_order(callback, bot, callback_data)
 
-    await callback.answer()
-    chekmessage = await bot.send_photo(chat_id=admin, caption='Проверьте оплату на корректность:', photo=photo, reply_markup=kb.succsefull_keyboard_kurs)
-    await asyncio.sleep(900)
-    await chekmessage.delete()
+@router.callback_query(kb.OrderReview.filter((F.action == 'reject_no') & (F.data_type == 'kurs')))
+@log_user_action
+async def UnConfirmanswerkurs(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    await review_again(callback, bot, callback_data)
+
+@router.callback_query(kb.OrderReview.filter((F.action == 'approve_no') & (F.data_type == 'kurs')))
+@log_user_action
+async def UnConfirmanswernokurs(callback: CallbackQuery, bot: Bot, callback_data: kb.OrderReview):
+    await review_again(callback, bot, callback_data)
 
 @router.message()
 @log_user_action
@@ -3,6 +3,7 @@ from aiogram.filters import CommandStart
 from aiogram.types import Message
 
 import database.requests as rq
+from utils.funnel import funnel
 
 
 router = Router()
@@ -10,6 +11,7 @@ router = Router()
 
 @router.message(CommandStart())
 async def start(message: Message, bot: Bot) -> None:
-    await rq.set_user(message.from_user.id, message.from_user.full_name)
+    rq.register_user(message.from_user.id, message.from_user.full_name)
+    funnel.hit('start')
     await bot.send_message(message.from_user.id, f'Здравствуй! {html.bold(message.from_user.full_name)}!')
     
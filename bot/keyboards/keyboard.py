@@ -1,8 +1,9 @@
 from aiogram.types import (InlineKeyboardMarkup, InlineKeyboardButton)
 
+from aiogram.filters.callback_data import CallbackData
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from database.requests import select_gaid, select_kurs
+from database.catalog import catalog
 
 admincompkeyboard = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text='Добавить гайд', callback_data='keyboardaddgaid')], [InlineKeyboardButton(text='Добавить курс', callback_data='keyboardaddkurs')], [InlineKeyboardButton(text='Удалить гайд', callback_data='keyboard_delete_gaid')], [InlineKeyboardButton(text='Удалить курс', callback_data='keyboard_delete_kurs')],
@@ -17,98 +18,111 @@ list = InlineKeyboardMarkup(inline_keyboard=[
 ])
 
 
-payment_keyboard_gaid = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Оплата ⭐️', callback_data='stars_gaid', pay=True)],
-    [InlineKeyboardButton(text='Оплата 💳', callback_data='cards_gaid', pay=True)]
-], resize_keyboard=True)
+class OrderReview(CallbackData, prefix='order'):
+    """Кнопки проверки оплаты картой, например 'order:approve:gaid:15'."""
+    action: str
+    data_type: str
+    order_id: int
 
 
-payment_keyboard_kurs = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Оплата ⭐️', callback_data='stars_kurs', pay=True)],
-    [InlineKeyboardButton(text='Оплата 💳', callback_data='cards_kurs', pay=True)]
-], resize_keyboard=True)
+def order_review_keyboard(order_id, data_type):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='Подтверждаю ✅', callback_data=OrderReview(action='approve', data_type=data_type, order_id=order_id).pack())],
+        [InlineKeyboardButton(text='Не подтверждаю ❌', callback_data=OrderReview(action='reject', data_type=data_type, order_id=order_id).pack())]
+    ])
 
 
-succsefull_keyboard_gaid = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Подтверждаю ✅', callback_data='true_gaid')],
-    [InlineKeyboardButton(text='Не подтверждаю ❌', callback_data='false_gaid')]
-], resize_keyboard=True)
+def order_approve_keyboard(order_id, data_type):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='Да ✅', callback_data=OrderReview(action='approve_yes', data_type=data_type, order_id=order_id).pack())],
+        [InlineKeyboardButton(text='Нет ❌', callback_data=OrderReview(action='approve_no', data_type=data_type, order_id=order_id).pack())]
+    ])
 
 
-confirmation_gaid = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Да ✅', callback_data='ok_gaid')],
-    [InlineKeyboardButton(text='Нет ❌', callback_data='no_gaid')]
-], resize_keyboard=True)
+def order_reject_keyboard(order_id, data_type):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='Да ✅', callback_data=OrderReview(action='reject_yes', data_type=data_type, order_id=order_id).pack())],
+        [InlineKeyboardButton(text='Нет ❌', callback_data=OrderReview(action='reject_no', data_type=data_type, order_id=order_id).pack())]
+    ])
 
 
-confirmation_false_gaid = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Да ✅', callback_data='yes_false_gaid')],
-    [InlineKeyboardButton(text='Нет ❌', callback_data='no_false_gaid')]
-], resize_keyboard=True)
+class DeliveryRetry(CallbackData, prefix='delivery'):
+    delivery_id: int
 
 
-succsefull_keyboard_kurs = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Подтверждаю ✅', callback_data='true_kurs')],
-    [InlineKeyboardButton(text='Не подтверждаю ❌', callback_data='false_kurs')]
-], resize_keyboard=True)
+def dead_delivery_keyboard(delivery_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='Повторить 🔁', callback_data=DeliveryRetry(delivery_id=delivery_id).pack())]
+    ])
 
 
-confirmation_kurs = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Да ✅', callback_data='ok_kurs')],
-    [InlineKeyboardButton(text='Нет ❌', callback_data='no_kurs')]
-], resize_keyboard=True)
+def broadcast_progress_keyboard(job_id, paused):
+    if paused:
+        toggle = InlineKeyboardButton(text='Продолжить ▶️', callback_data=f'broadcast_resume_{job_id}')
+    else:
+        toggle = InlineKeyboardButton(text='Пауза ⏸', callback_data=f'broadcast_pause_{job_id}')
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [toggle, InlineKeyboardButton(text='Отменить ⛔️', callback_data=f'broadcast_cancel_{job_id}')]
+    ])
 
 
-confirmation_false_kurs = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Да ✅', callback_data='yes_false_kurs')],
-    [InlineKeyboardButton(text='Нет ❌', callback_data='no_false_kurs')]
-], resize_keyboard=True)
 
+class CatalogItem(CallbackData, prefix='item'):
+    """Кнопка товара каталога: действие, тип и id товара, например 'item:select:gaid:12'."""
+    action: str
+    data_type: str
+    item_id: int
 
 
-async def selectkeyboardgaid():
-    all_gaid = await select_gaid()
+def payment_keyboard(data_type, item_id):
+    """Кнопки оплаты товара: id товара едет в callback_data, а не в состоянии FSM."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='Оплата ⭐️', callback_data=CatalogItem(action='stars', data_type=data_type, item_id=item_id).pack(), pay=True)],
+        [InlineKeyboardButton(text='Оплата 💳', callback_data=CatalogItem(action='card', data_type=data_type, item_id=item_id).pack(), pay=True)]
+    ])
+
+
+# Готовые клавиатуры каталога: (тип, действие) -> (версия каталога, клавиатура).
+# Клавиатура общая для всех пользователей, поэтому ее нельзя менять после сборки.
+_catalog_keyboards: dict[tuple[str, str], tuple[int, InlineKeyboardMarkup]] = {}
+
+
+async def catalog_keyboard(data_type, action):
+    """Клавиатура со всеми товарами типа data_type, пересобирается только при смене версии каталога."""
+    snapshot = await catalog.get()
+    cached = _catalog_keyboards.get((data_type, action))
+    if cached and cached[0] == snapshot.version:
+        return cached[1]
     keyboard = InlineKeyboardBuilder()
-    for gaid in all_gaid:
-        keyboard.add(InlineKeyboardButton(text=gaid.name_fail_gaid, callback_data=f"selectgaid_{gaid.name_fail_gaid}"))
-    return keyboard.adjust(2).as_markup()
+    for item in snapshot.items[data_type]:
+        keyboard.add(InlineKeyboardButton(
+            text=getattr(item, f'name_fail_{data_type}'),
+            callback_data=CatalogItem(action=action, data_type=data_type, item_id=item.id).pack()
+        ))
+    markup = keyboard.adjust(2).as_markup()
+    _catalog_keyboards[(data_type, action)] = (snapshot.version, markup)
+    return markup
+
+
+async def selectkeyboardgaid():
+    return await catalog_keyboard('gaid', 'select')
 
 
 async def selectkeyboardkurs():
-    all_kurs = await select_kurs()
-    keyboard = InlineKeyboardBuilder()
-    for kurs in all_kurs:
-        keyboard.add(InlineKeyboardButton(text=kurs.name_fail_kurs, callback_data=f"selectkurs_{kurs.name_fail_kurs}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_keyboard('kurs', 'select')
 
 
 async def sendkeyboardkurs():
-    all_kurs = await select_kurs()
-    keyboard = InlineKeyboardBuilder()
-    for kurs in all_kurs:
-        keyboard.add(InlineKeyboardButton(text=kurs.name_fail_kurs, callback_data=f"sendkurs_{kurs.name_fail_kurs}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_keyboard('kurs', 'send')
 
 
 async def sendkeyboardgaid():
-    all_gaid = await select_gaid()
-    keyboard = InlineKeyboardBuilder()
-    for gaid in all_gaid:
-        keyboard.add(InlineKeyboardButton(text=gaid.name_fail_gaid, callback_data=f"sendgaid_{gaid.name_fail_gaid}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_keyboard('gaid', 'send')
 
 
 async def delit_keyboard_gaid():
-    all_gaid = await select_gaid()
-    keyboard = InlineKeyboardBuilder()
-    for gaid in all_gaid:
-        keyboard.add(InlineKeyboardButton(text=gaid.name_fail_gaid, callback_data=f"delitg_{gaid.name_fail_gaid}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_keyboard('gaid', 'delete')
 
 
 async def delit_keyboard_kurs():
-    all_kurs = await select_kurs()
-    keyboard = InlineKeyboardBuilder()
-    for kurs in all_kurs:
-        keyboard.add(InlineKeyboardButton(text=kurs.name_fail_kurs, callback_data=f"delitk_{kurs.name_fail_kurs}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_keyboard('kurs', 'delete')
@@ -9,23 +9,35 @@ from aiohttp import web
 from aiogram import Bot, Dispatcher, F
 from handlers.starthandler import router
 from database.models import async_main
+import database.requests as rq
+from database.catalog import catalog
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiogram.fsm.storage.memory import MemoryStorage
+from database.fsm_storage import SQLiteStorage
 from utils.commands import set_commands
 from admin.handlerauthadmin import authorization_start
 from admin.handler_add_data import add_gaid, add_gaid_name, add_gaid_photo, add_gaid_description, add_gaid_file, add_gaid_price_card, add_gaid_price_star, add_kurs
 from admin. handler_delit_data import start_on_delit_gaid, drop_gaid, start_on_delit_kurs, drop_kurs
 from handlers.handler_output_data import gaid_start, gaid_select, buy_gaid, successful_payment_gaid, pre_checkout_query_gaid, pay_photo_check_get_gaid, Trueanswer, Falseanswer, Confirmanswer, UnConfirmanswer, UnConfirmanswerno, ConfirmanswerYes, successful_photo_gaid, kurs_start, kurs_select, buy_kurs, successful_payment_kurs, pay_photo_check_get_kurs, successful_photo_kurs, Trueanswerkurs, Falseanswerkurs, Confirmanswerkurs, UnConfirmanswerkurs, ConfirmanswerYeskurs, UnConfirmanswernokurs, cancel_any_state
-from admin.sendall import rassilka, kurs, kurssendall, gaids, gaidsendall
+from admin.sendall import rassilka, kurs, kurssendall, gaids, gaidsendall, broadcast_control
 from admin.custom_sendall import function_custom_message, get_custom_message
-from admin.statistic import statistica
+from admin.statistic import statistica, funnel_stats
+from admin.deliveries import dead_deliveries, retry_delivery
+from admin.filecheck import check_files
+from admin.catalog_import import import_catalog
+from utils.broadcast import resume_broadcasts
+from utils.funnel import funnel
+from utils.scheduler import deletions
+from utils.delivery_queue import delivery_queue
+from utils.file_health import file_health
+from utils.ratelimit import PriorityRateLimiter, Lane, lane
 
 from aiogram.filters import Command
 from admin.handler_add_data import AddDataStates
 from admin.custom_sendall import Custom_message
 from handlers.handler_output_data import CardPayStates
+from keyboards.keyboard import CatalogItem, OrderReview, DeliveryRetry
 
 
 load_dotenv('./.env')
@@ -49,17 +61,15 @@ sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
 
 bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# Все исходящие запросы идут через общий лимит с приоритетами: платежи и ответы, затем админ, затем рассылки
+bot.session.middleware(PriorityRateLimiter(rate=float(os.getenv('BOT_API_RATE', 30))))
 
-storage = MemoryStorage()
+# Состояния FSM хранятся в базе: незавершенные оплаты и добавления товаров переживают перезапуск
+storage = SQLiteStorage()
 
 dp = Dispatcher(storage=storage)
 
 
-async def cleanup_old_states():
-    while True:
-        await asyncio.sleep(3600)
-
-
 async def send_error_notification(bot: Bot, error: Exception):
     """
     Отправляет уведомление администратору об ошибке.
@@ -76,7 +86,8 @@ async def send_error_notification(bot: Bot, error: Exception):
             f"<b>Описание:</b> <code>{str(error)[:100]}...</code>\n\n"
             "Проверьте логи для деталей."
         )
-        await bot.send_message(admin_id, error_message)
+        with lane(Lane.ADMIN):
+            await bot.send_message(admin_id, error_message)
     except Exception as e:
         logging.error(f"Не удалось отправить уведомление об ошибке: {e}")
 
@@ -124,58 +135,62 @@ dp.message.register(add_gaid_price_card, AddDataStates.price_card)
 dp.message.register(add_gaid_price_star, AddDataStates.price_star)
 
 dp.message.register(gaid_start, Command(commands='gaid'))
-dp.callback_query.register(gaid_select, F.data.startswith('selectgaid_'))
-dp.callback_query.register(buy_gaid, F.data.startswith('stars_gaid'))
+dp.callback_query.register(gaid_select, CatalogItem.filter((F.action == 'select') & (F.data_type == 'gaid')))
+dp.callback_query.register(buy_gaid, CatalogItem.filter((F.action == 'stars') & (F.data_type == 'gaid')))
 dp.pre_checkout_query.register(pre_checkout_query_gaid)
-dp.message.register(successful_payment_gaid, F.successful_payment.invoice_payload == 'gaid')
-dp.callback_query.register(pay_photo_check_get_gaid, F.data.startswith('cards_gaid'))
+dp.message.register(successful_payment_gaid, F.successful_payment.invoice_payload.startswith('gaid:'))
+dp.callback_query.register(pay_photo_check_get_gaid, CatalogItem.filter((F.action == 'card') & (F.data_type == 'gaid')))
 dp.message.register(successful_photo_gaid, CardPayStates.successful_photo_gaid)
 
 dp.callback_query.register(start_on_delit_gaid, F.data.startswith('keyboard_delete_gaid'))
-dp.callback_query.register(drop_gaid, F.data.startswith('delitg_'))
+dp.callback_query.register(drop_gaid, CatalogItem.filter((F.action == 'delete') & (F.data_type == 'gaid')))
 
 
 dp.callback_query.register(add_kurs, F.data.startswith('keyboardaddkurs'))
 
 
 dp.message.register(kurs_start, Command(commands='kurs'))
-dp.callback_query.register(kurs_select, F.data.startswith('selectkurs_'))
-dp.callback_query.register(buy_kurs, F.data.startswith('stars_kurs'))
-dp.message.register(successful_payment_kurs, F.successful_payment.invoice_payload == 'kurs')
+dp.callback_query.register(kurs_select, CatalogItem.filter((F.action == 'select') & (F.data_type == 'kurs')))
+dp.callback_query.register(buy_kurs, CatalogItem.filter((F.action == 'stars') & (F.data_type == 'kurs')))
+dp.message.register(successful_payment_kurs, F.successful_payment.invoice_payload.startswith('kurs:'))
 
 dp.message.register(cancel_any_state, Command(commands=['gaid', 'kurs']))
 
 dp.callback_query.register(start_on_delit_kurs, F.data.startswith('keyboard_delete_kurs'))
-dp.callback_query.register(drop_kurs, F.data.startswith('delitk_'))
+dp.callback_query.register(drop_kurs, CatalogItem.filter((F.action == 'delete') & (F.data_type == 'kurs')))
 
 
 dp.callback_query.register(rassilka, F.data.startswith('keyboardrassilka'))
 dp.callback_query.register(kurs, F.data == 'sendkurs')
-dp.callback_query.register(kurssendall, F.data.startswith('sendkurs_'))
+dp.callback_query.register(kurssendall, CatalogItem.filter((F.action == 'send') & (F.data_type == 'kurs')))
 dp.callback_query.register(gaids, F.data == 'sendgaids')
-dp.callback_query.register(gaidsendall, F.data.startswith('sendgaid_'))
+dp.callback_query.register(gaidsendall, CatalogItem.filter((F.action == 'send') & (F.data_type == 'gaid')))
+dp.callback_query.register(broadcast_control, F.data.startswith('broadcast_'))
 dp.callback_query.register(function_custom_message, F.data == 'custom_message')
 dp.message.register(get_custom_message, Custom_message.msg_custom)
 
 dp.callback_query.register(statistica, F.data.startswith('keyboardstatistika'))
-
-dp.callback_query.register(pay_photo_check_get_gaid, F.data.startswith('cards_gaid'))
-dp.message.register(successful_photo_gaid, CardPayStates.successful_photo_gaid)
-dp.callback_query.register(Trueanswer, F.data.startswith('true_gaid'))
-dp.callback_query.register(Falseanswer, F.data.startswith('false_gaid'))
-dp.callback_query.register(Confirmanswer, F.data.startswith('yes_false_gaid'))
-dp.callback_query.register(UnConfirmanswer, F.data.startswith('no_false_gaid'))
-dp.callback_query.register(ConfirmanswerYes, F.data.startswith('ok_gaid'))
-dp.callback_query.register(UnConfirmanswerno, F.data.startswith('no_gaid'))
-
-dp.callback_query.register(pay_photo_check_get_kurs, F.data.startswith('cards_kurs'))
+dp.message.register(funnel_stats, Command(commands='funnel'))
+dp.message.register(dead_deliveries, Command(commands='deliveries'))
+dp.callback_query.register(retry_delivery, DeliveryRetry.filter())
+dp.message.register(check_files, Command(commands='checkfiles'))
+dp.message.register(import_catalog, Command(commands='import'))
+
+dp.callback_query.register(Trueanswer, OrderReview.filter((F.action == 'approve') & (F.data_type == 'gaid')))
+dp.callback_query.register(Falseanswer, OrderReview.filter((F.action == 'reject') & (F.data_type == 'gaid')))
+dp.callback_query.register(Confirmanswer, OrderReview.filter((F.action == 'reject_yes') & (F.data_type == 'gaid')))
+dp.callback_query.register(UnConfirmanswer, OrderReview.filter((F.action == 'reject_no') & (F.data_type == 'gaid')))
+dp.callback_query.register(ConfirmanswerYes, OrderReview.filter((F.action == 'approve_yes') & (F.data_type == 'gaid')))
+dp.callback_query.register(UnConfirmanswerno, OrderReview.filter((F.action == 'approve_no') & (F.data_type == 'gaid')))
+
+dp.callback_query.register(pay_photo_check_get_kurs, CatalogItem.filter((F.action == 'card') & (F.data_type == 'kurs')))
 dp.message.register(successful_photo_kurs, CardPayStates.successful_photo_kurs)
-dp.callback_query.register(Trueanswerkurs, F.data.startswith('true_kurs'))
-dp.callback_query.register(Falseanswerkurs, F.data.startswith('false_kurs'))
-dp.callback_query.register(Confirmanswerkurs, F.data.startswith('yes_false_kurs'))
-dp.callback_query.register(UnConfirmanswerkurs, F.data.startswith('no_false_kurs'))
-dp.callback_query.register(ConfirmanswerYeskurs, F.data.startswith('ok_kurs'))
-dp.callback_query.register(UnConfirmanswernokurs, F.data.startswith('no_kurs'))
+dp.callback_query.register(Trueanswerkurs, OrderReview.filter((F.action == 'approve') & (F.data_type == 'kurs')))
+dp.callback_query.register(Falseanswerkurs, OrderReview.filter((F.action == 'reject') & (F.data_type == 'kurs')))
+dp.callback_query.register(Confirmanswerkurs, OrderReview.filter((F.action == 'reject_yes') & (F.data_type == 'kurs')))
+dp.callback_query.register(UnConfirmanswerkurs, OrderReview.filter((F.action == 'reject_no') & (F.data_type == 'kurs')))
+dp.callback_query.register(ConfirmanswerYeskurs, OrderReview.filter((F.action == 'approve_yes') & (F.data_type == 'kurs')))
+dp.callback_query.register(UnConfirmanswernokurs, OrderReview.filter((F.action == 'approve_no') & (F.data_type == 'kurs')))
 
 dp.errors.register(errors_handler)
 
@@ -192,7 +207,17 @@ async def healthcheck(request: web.Request) -> web.Response:
 async def main() -> None:
     print("Бот запущен! Проверка вебхука...")
     await async_main()
+    storage.start()
+    await catalog.reload()
+    rq.user_batcher.start()
+    rq.event_batcher.start()
+    await funnel.load()
+    funnel.start()
+    await deletions.start(bot)
+    await delivery_queue.start(bot)
+    file_health.start(bot)
     await set_commands(bot)
+    await resume_broadcasts(bot)
     
     if IS_WEBHOOK == 1:
         print("Запуск в режиме WEBHOOK...")
@@ -231,7 +256,14 @@ async def main() -> None:
             print(f"\nКритическая ошибка: {e}")
         finally:
             print("Останавливаем бота...")
+            await file_health.stop()
+            await delivery_queue.stop()
+            await rq.user_batcher.stop()
+            await rq.event_batcher.stop()
+            await funnel.stop()
+            await deletions.stop()
             await bot.session.close()
+            await dp.storage.close()
             await runner.cleanup()
             print("Бот успешно остановлен")
     else:
@@ -253,6 +285,12 @@ async def main() -> None:
             raise
         finally:
             print("Останавливаем бота...")
+            await file_health.stop()
+            await delivery_queue.stop()
+            await rq.user_batcher.stop()
+            await rq.event_batcher.stop()
+            await funnel.stop()
+            await deletions.stop()
             await bot.session.close()
             await dp.storage.close()
             print("Бот успешно остановлен")
@@ -261,7 +299,6 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     try:
         asyncio.run(main())
-        asyncio.create_task(cleanup_old_states())
     except KeyboardInterrupt:
         print("\nБот был остановлен пользователем")
     
\ No newline at end of file
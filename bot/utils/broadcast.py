@@ -0,0 +1,496 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import AsyncIterable, Awaitable, Callable, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database.requests as rq
+import keyboards.keyboard as kb
+from utils.ratelimit import PerChatLimiter, Lane, lane, current_lane
+
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 64))
+MAX_RETRY_AFTER_ATTEMPTS = 5
+# Сколько получателей за раз помечается как 'sending' перед отправкой
+CLAIM_CHUNK_SIZE = 200
+# После скольких изменений флага active сбрасываем их в базу
+ACTIVE_FLUSH_SIZE = 500
+# Как часто обновлять сообщение с прогрессом рассылки, секунды
+PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))
+# Сбой рассылки (например, занятая база) повторяется с того же места: задержка BASE * 2^(попытка-1)
+JOB_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', 3))
+JOB_RETRY_DELAY = 10.0
+
+SendFunc = Callable[[int], Awaitable[object]]
+ResultFunc = Callable[[int, str], Awaitable[None]]
+
+
+@dataclass
+class BroadcastStats:
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+
+class BroadcastCancelled(Exception):
+    pass
+
+
+class JobControl:
+    """Пауза, продолжение и отмена рассылки из админского чата."""
+
+    def __init__(self, paused: bool = False):
+        self.running = asyncio.Event()
+        self.changed = asyncio.Event()
+        self.cancelled = False
+        # Время без пауз, для скорости и оценки остатка
+        self.active_time = 0.0
+        self.active_since: float | None = None
+        if not paused:
+            self.running.set()
+            self.active_since = time.monotonic()
+
+    def active_seconds(self) -> float:
+        if self.active_since is None:
+            return self.active_time
+        return self.active_time + time.monotonic() - self.active_since
+
+    @property
+    def paused(self) -> bool:
+        return not self.running.is_set()
+
+    def _notify(self):
+        self.changed.set()
+
+    def pause(self):
+        if self.active_since is not None:
+            self.active_time += time.monotonic() - self.active_since
+            self.active_since = None
+        self.running.clear()
+        self._notify()
+
+    def resume(self):
+        if self.active_since is None:
+            self.active_since = time.monotonic()
+        self.running.set()
+        self._notify()
+
+    def cancel(self):
+        self.cancelled = True
+        self.running.set()
+        self._notify()
+
+
+class ActiveFlagBuffer:
+    """Копит изменения users.active и записывает их несколькими массовыми UPDATE."""
+
+    def __init__(self, flush_size: int = ACTIVE_FLUSH_SIZE):
+        self.flush_size = flush_size
+        self.pending: dict[int, list[int]] = {0: [], 1: []}
+        self.lock = asyncio.Lock()
+
+    async def mark(self, tg_id: int, active: int):
+        self.pending[active].append(tg_id)
+        if len(self.pending[active]) >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            pending, self.pending = self.pending, {0: [], 1: []}
+            for active, tg_ids in pending.items():
+                await rq.set_active_bulk(tg_ids, active)
+
+
+class Broadcaster:
+    """Конкурентная рассылка с ограничением скорости.
+
+    Общий лимит на все запросы бота держит PriorityRateLimiter, рассылка идет в нем
+    в полосе Lane.BULK. В каждый чат пишем не чаще раза в секунду, на TelegramRetryAfter
+    повторяем отправку после указанного Telegram времени.
+    """
+
+    def __init__(self, bot: Bot, workers: int = BROADCAST_WORKERS,
+                 on_result: ResultFunc | None = None, control: JobControl | None = None):
+        self.bot = bot
+        self.on_result = on_result
+        self.control = control or JobControl()
+        self.stats = BroadcastStats()
+        self.active_flags = ActiveFlagBuffer()
+        self.chat_limiter = PerChatLimiter()
+        self.workers = workers
+
+    async def _deliver(self, chat_id: int, send: SendFunc):
+        for _ in range(MAX_RETRY_AFTER_ATTEMPTS):
+            await self.control.running.wait()
+            if self.control.cancelled:
+                raise BroadcastCancelled()
+            await self.chat_limiter.acquire(chat_id)
+            # Пока воркер ждал очереди, рассылку могли поставить на паузу или отменить
+            await self.control.running.wait()
+            if self.control.cancelled:
+                raise BroadcastCancelled()
+            try:
+                return await send(chat_id)
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control при рассылке, ждем {e.retry_after}с")
+                self.chat_limiter.pause(chat_id, e.retry_after)
+        raise RuntimeError(f"Не удалось отправить {chat_id}: превышено число повторов после RetryAfter")
+
+    async def _worker(self, queue: asyncio.Queue, send: SendFunc):
+        # У каждой задачи-воркера своя копия контекста, полоса меняется только для нее
+        current_lane.set(Lane.BULK)
+        stats = self.stats
+        while True:
+            item = await queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            tg_id, active = item
+            try:
+                await self._deliver(tg_id, send)
+                stats.sent += 1
+                status = 'sent'
+            except BroadcastCancelled:
+                # Получатель уже помечен, но сообщение не ушло - возвращаем его в очередь задачи
+                status = 'pending'
+            except TelegramForbiddenError:
+                stats.blocked += 1
+                status = 'blocked'
+            except TelegramBadRequest as e:
+                logger.warning(f"Ошибка при отправке пользователю {tg_id}: {e}")
+                stats.failed += 1
+                status = 'failed'
+            except Exception as e:
+                logger.error(f"Ошибка при отправке пользователю {tg_id}: {e}")
+                stats.failed += 1
+                status = 'failed'
+            try:
+                # Пишем в базу только если флаг действительно изменился
+                if status == 'sent' and int(active) != 1:
+                    await self.active_flags.mark(tg_id, 1)
+                elif status == 'blocked' and int(active) != 0:
+                    await self.active_flags.mark(tg_id, 0)
+                if self.on_result is not None:
+                    await self.on_result(tg_id, status)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить результат отправки {tg_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def run(self, recipients: Iterable | AsyncIterable, send: SendFunc) -> BroadcastStats:
+        """Отправляет send(tg_id) каждому получателю вида (tg_id, active)."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue, send)) for _ in range(self.workers)]
+        try:
+            if isinstance(recipients, AsyncIterable):
+                async for recipient in recipients:
+                    if self.control.cancelled:
+                        break
+                    await queue.put(recipient)
+            else:
+                for recipient in recipients:
+                    if self.control.cancelled:
+                        break
+                    await queue.put(recipient)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self.active_flags.flush()
+        return self.stats
+
+
+def report_text(counts: dict[str, int], cancelled: bool = False) -> str:
+    sent = counts.get('sent', 0)
+    # 'sending' остается только у тех, кому отправляли в момент перезапуска бота:
+    # скорее всего, сообщение дошло, но проверить это нельзя
+    unknown = counts.get('sending', 0)
+    not_sent = sum(count for status, count in counts.items() if status not in ('sent', 'sending'))
+    if cancelled:
+        text = f'Рассылка отменена. Отправлено {sent} пользователям. Не отправлено {not_sent} пользователям.'
+    elif sent > 0:
+        text = f'Успешная рассылка. Отправлено {sent} пользователям. Не удалось отправить {not_sent} пользователям.'
+    else:
+        text = f'Не успешная рассылка. Не удалось отправить {not_sent} пользователям.'
+    if unknown:
+        text += f' Статус неизвестен у {unknown} пользователей (отправка шла во время перезапуска бота).'
+    return text
+
+
+def make_sender(bot: Bot, calls: list[dict]) -> SendFunc:
+    """Собирает функцию отправки из сохраненного в задаче списка вызовов Bot API."""
+
+    async def send(chat_id: int):
+        for call in calls:
+            await getattr(bot, call['method'])(chat_id=chat_id, **call['params'])
+
+    return send
+
+
+class JobRecorder:
+    """Копит результаты отправки и пишет их в broadcast_recipients пачками."""
+
+    def __init__(self, job_id: int, flush_size: int = CLAIM_CHUNK_SIZE):
+        self.job_id = job_id
+        self.flush_size = flush_size
+        self.pending: dict[str, list[int]] = {}
+        self.size = 0
+        self.lock = asyncio.Lock()
+
+    async def record(self, tg_id: int, status: str):
+        self.pending.setdefault(status, []).append(tg_id)
+        self.size += 1
+        if self.size >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            pending, self.pending, self.size = self.pending, {}, 0
+            for status, tg_ids in pending.items():
+                await rq.set_broadcast_recipients_status(self.job_id, tg_ids, status)
+
+
+async def claimed_recipients(job_id: int, recorder: JobRecorder):
+    """Отдает получателей задачи порциями, перед каждой порцией сохраняя результаты."""
+    last_tg_id = 0
+    while True:
+        await recorder.flush()
+        chunk = await rq.claim_broadcast_recipients(job_id, CLAIM_CHUNK_SIZE, last_tg_id)
+        if not chunk:
+            return
+        last_tg_id = chunk[-1][0]
+        for recipient in chunk:
+            yield recipient
+
+
+async def prepare_job(job_id: int):
+    """Заполняет список получателей, читая пользователей порциями.
+
+    Вставка идемпотентна, поэтому прерванную подготовку можно просто повторить.
+    """
+    async for chunk in rq.iter_users():
+        await rq.add_broadcast_recipients(job_id, [tg_id for tg_id, _ in chunk])
+
+
+def _format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours} ч {minutes} мин'
+    if minutes:
+        return f'{minutes} мин {seconds} с'
+    return f'{seconds} с'
+
+
+class ProgressMessage:
+    """Одно сообщение в чате админа с прогрессом рассылки, обновляется не чаще PROGRESS_INTERVAL."""
+
+    def __init__(self, bot: Bot, job_id: int, admin_id: int, control: JobControl,
+                 stats: BroadcastStats, counts: dict[str, int]):
+        self.bot = bot
+        self.job_id = job_id
+        self.admin_id = admin_id
+        self.control = control
+        self.stats = stats
+        self.total = sum(counts.values())
+        # Результаты прошлых запусков задачи до перезапуска бота
+        self.before = {status: counts.get(status, 0) for status in ('sent', 'failed', 'blocked', 'sending')}
+        self.active_started = control.active_seconds()
+        self.message_id = None
+        self.last_text = None
+        self.task = None
+
+    def text(self, finished: bool = False) -> str:
+        sent = self.before['sent'] + self.stats.sent
+        failed = self.before['failed'] + self.stats.failed
+        blocked = self.before['blocked'] + self.stats.blocked
+        unknown = self.before['sending']
+        # Паузы в скорость не входят, иначе после долгой паузы оценка остатка раздувается
+        elapsed = max(self.control.active_seconds() - self.active_started, 0.001)
+        rate = self.stats.processed / elapsed
+        remaining = self.total - sent - failed - blocked - unknown
+
+        if finished:
+            state = 'отменена' if self.control.cancelled else 'завершена'
+        elif self.control.paused:
+            state = 'на паузе'
+        else:
+            state = 'идет'
+        lines = [
+            f'📨 Рассылка #{self.job_id} {state}',
+            f'Отправлено: {sent} из {self.total}',
+            f'Не доставлено: {failed}',
+            f'Заблокировали бота: {blocked}',
+        ]
+        if unknown:
+            lines.append(f'Статус неизвестен (отправка шла во время перезапуска): {unknown}')
+        lines.append(f'Скорость: {rate:.1f} сообщ./с')
+        if not finished and remaining > 0 and rate > 0 and not self.control.paused:
+            lines.append(f'Осталось: ~{_format_eta(remaining / rate)}')
+        return '\n'.join(lines)
+
+    async def update(self, finished: bool = False):
+        text = self.text(finished)
+        if text == self.last_text:
+            return
+        markup = None if finished else kb.broadcast_progress_keyboard(self.job_id, self.control.paused)
+        try:
+            with lane(Lane.ADMIN):
+                if self.message_id is None:
+                    message = await self.bot.send_message(self.admin_id, text=text, reply_markup=markup)
+                    self.message_id = message.message_id
+                else:
+                    await self.bot.edit_message_text(text=text, chat_id=self.admin_id,
+                                                     message_id=self.message_id, reply_markup=markup)
+            self.last_text = text
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки {self.job_id}: {e}")
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.control.changed.wait(), PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.control.changed.clear()
+            await self.update()
+
+    async def start(self):
+        await self.update()
+        self.task = asyncio.create_task(self._loop())
+
+    async def finish(self):
+        if self.task is not None:
+            self.task.cancel()
+        await self.update(finished=True)
+
+
+async def _run_job_once(bot: Bot, job_id: int, control: JobControl):
+    job = await rq.get_broadcast_job(job_id)
+    calls = json.loads(job.payload)
+    recorder = JobRecorder(job_id)
+    try:
+        if job.status == 'preparing':
+            await prepare_job(job_id)
+            await rq.set_broadcast_job_status(job_id, 'running')
+        broadcaster = Broadcaster(bot, on_result=recorder.record, control=control)
+        progress = ProgressMessage(bot, job_id, job.admin_id, control, broadcaster.stats,
+                                   await rq.get_broadcast_job_counts(job_id))
+        await progress.start()
+        try:
+            stats = await broadcaster.run(claimed_recipients(job_id, recorder), make_sender(bot, calls))
+            await recorder.flush()
+        finally:
+            await progress.finish()
+    except Exception:
+        try:
+            await recorder.flush()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить результаты рассылки {job_id}: {e}")
+        raise
+    if control.cancelled:
+        # Остаток забранной порции до воркеров не дошел и так и остался бы в 'sending'
+        await rq.release_broadcast_recipients(job_id)
+    await rq.set_broadcast_job_status(job_id, 'cancelled' if control.cancelled else 'done')
+    logger.info(f"Рассылка {job_id} завершена: {stats}")
+    counts = await rq.get_broadcast_job_counts(job_id)
+    await bot.send_message(job.admin_id, text=report_text(counts, control.cancelled))
+
+
+async def run_job(bot: Bot, job_id: int):
+    """Выполняет рассылку, после сбоя продолжая ее с того же места.
+
+    После JOB_MAX_ATTEMPTS сбоев подряд задача получает статус 'failed' и больше не
+    считается идущей, так что такую же рассылку можно запустить заново.
+    """
+    # Служебные сообщения рассылки админу идут в полосе ADMIN, сама рассылка - в BULK
+    current_lane.set(Lane.ADMIN)
+    job = await rq.get_broadcast_job(job_id)
+    control = _controls.setdefault(job_id, JobControl(paused=job.status == 'paused'))
+    try:
+        for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+            try:
+                await _run_job_once(bot, job_id, control)
+                return
+            except Exception as e:
+                logger.exception(f"Рассылка {job_id} прервана (попытка {attempt}): {e}")
+                error = e
+            try:
+                # Забранные, но не отправленные получатели снова ждут отправки
+                await rq.release_broadcast_recipients(job_id)
+            except Exception as e:
+                logger.error(f"Не удалось вернуть получателей рассылки {job_id}: {e}")
+            if attempt < JOB_MAX_ATTEMPTS and not control.cancelled:
+                await asyncio.sleep(JOB_RETRY_DELAY * 2 ** (attempt - 1))
+                continue
+            break
+        try:
+            await rq.set_broadcast_job_status(job_id, 'cancelled' if control.cancelled else 'failed')
+        except Exception as e:
+            logger.error(f"Не удалось закрыть прерванную рассылку {job_id}: {e}")
+        await bot.send_message(job.admin_id, text=f'Рассылка прервана из-за ошибки: {error}\n'
+                                                  'Ее можно запустить заново.')
+    finally:
+        _controls.pop(job_id, None)
+
+
+# Ссылки на фоновые рассылки, чтобы задачи не собрал сборщик мусора
+_running: set[asyncio.Task] = set()
+_controls: dict[int, JobControl] = {}
+
+
+def _spawn(bot: Bot, job_id: int) -> asyncio.Task:
+    task = asyncio.create_task(run_job(bot, job_id))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return task
+
+
+async def start_broadcast(bot: Bot, kind: str, calls: list[dict], admin_id: int) -> bool:
+    """Сохраняет рассылку в базе и запускает ее в фоне.
+
+    Возвращает False, если такая же рассылка уже выполняется.
+    """
+    payload = json.dumps(calls, ensure_ascii=False, sort_keys=True)
+    job_id, created = await rq.create_broadcast_job(kind, payload, admin_id)
+    if created:
+        _spawn(bot, job_id)
+    return created
+
+
+async def control_broadcast(job_id: int, action: str) -> bool:
+    """Ставит рассылку на паузу, продолжает или отменяет. False - рассылка уже не идет."""
+    control = _controls.get(job_id)
+    if control is None:
+        return False
+    if action == 'pause':
+        control.pause()
+        await rq.set_broadcast_job_status(job_id, 'paused')
+    elif action == 'resume':
+        control.resume()
+        await rq.set_broadcast_job_status(job_id, 'running')
+    elif action == 'cancel':
+        control.cancel()
+    return True
+
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжает незавершенные рассылки после перезапуска с места остановки."""
+    for job in await rq.get_unfinished_broadcast_jobs():
+        logger.info(f"Возобновляю рассылку {job.id}")
+        _spawn(bot, job.id)
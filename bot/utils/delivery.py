@@ -0,0 +1,48 @@
+import os
+
+from aiogram import html
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Ограничение Telegram на длину подписи к медиа
+CAPTION_LIMIT = 1024
+
+DATA_NAMES = {'gaid': 'Гайд', 'kurs': 'Курс'}
+
+# Админы бота из .env; первый - основной
+ADMIN_IDS = [int(admin_id) for admin_id in (os.getenv('ADMIN_ID'), os.getenv('ADMIN_ID2')) if admin_id]
+
+
+def _field(item, name: str, data_type: str):
+    return getattr(item, f'{name}_{data_type}')
+
+
+def _fit(text: str) -> str:
+    return text if len(text) <= CAPTION_LIMIT else text[:CAPTION_LIMIT - 1] + '…'
+
+
+def product_caption(item, data_type: str) -> str:
+    """Подпись к файлу товара: название и описание в одном сообщении."""
+    return _fit(
+        f'{html.bold(DATA_NAMES[data_type] + ":")} {_field(item, "name_fail", data_type)}\n\n'
+        f'{_field(item, "description", data_type)}'
+    )
+
+
+def product_card(item, data_type: str) -> str:
+    """Подпись к обложке товара в каталоге: название, описание и цены."""
+    return _fit(
+        f'{html.bold(DATA_NAMES[data_type] + ":")} {_field(item, "name_fail", data_type)}\n'
+        f'{html.bold("Описание:")} {_field(item, "description", data_type)}\n'
+        f'{html.bold("Стоимость в рублях:")} {_field(item, "price_card", data_type)}\n'
+        f'{html.bold("Стоимость в звездах:")} {_field(item, "price_star", data_type)}'
+    )
+
+
+def product_broadcast_calls(item, data_type: str) -> list[dict]:
+    """Рассылка товара одним запросом: документ с описанием в подписи."""
+    return [{
+        'method': 'send_document',
+        'params': {'document': _field(item, 'fail', data_type), 'caption': product_caption(item, data_type)},
+    }]
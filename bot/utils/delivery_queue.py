@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+from dotenv import load_dotenv
+
+import database.requests as rq
+from database.catalog import catalog
+from utils.delivery import ADMIN_IDS, DATA_NAMES
+from utils.funnel import funnel
+from utils.ratelimit import Lane, lane
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 4))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv('DELIVERY_MAX_ATTEMPTS', 8))
+# Задержка перед повтором: BASE * 2^(попытка-1), но не больше MAX
+DELIVERY_BASE_DELAY = 5.0
+DELIVERY_MAX_DELAY = 3600.0
+# Как часто проверять очередь, если никто не разбудил
+DELIVERY_POLL_INTERVAL = 30.0
+
+
+class PermanentDeliveryError(Exception):
+    """Повторять бессмысленно: выдача сразу уходит в dead."""
+
+
+def backoff(attempts: int) -> float:
+    return min(DELIVERY_MAX_DELAY, DELIVERY_BASE_DELAY * 2 ** (attempts - 1))
+
+
+class DeliveryQueue:
+    """Фоновая выдача оплаченных файлов из таблицы deliveries.
+
+    Обработчики оплаты только ставят выдачу в очередь. Одна задача забирает
+    наступившие выдачи и отправляет не больше workers файлов одновременно.
+    Ошибки повторяются с экспоненциальной задержкой; после max_attempts попыток
+    или при ошибке, которую не исправить повтором, выдача получает статус dead,
+    о чем сообщается админам (/deliveries).
+    """
+
+    def __init__(self, workers: int = DELIVERY_WORKERS, max_attempts: int = DELIVERY_MAX_ATTEMPTS):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.slots = asyncio.Semaphore(workers)
+        self.in_flight: set[asyncio.Task] = set()
+        self.wakeup = asyncio.Event()
+        self.bot: Bot | None = None
+        self.task: asyncio.Task | None = None
+
+    def notify(self):
+        """Будит очередь: выдача уже записана в базу вместе с подтверждением заказа."""
+        self.wakeup.set()
+
+    async def _send(self, delivery):
+        item = (await catalog.get()).by_id.get(delivery.data_type, {}).get(delivery.item_id)
+        if item is None:
+            raise PermanentDeliveryError('Товар удален из каталога')
+        # Оплаченная выдача идет в приоритетной полосе, а не за рассылкой
+        with lane(Lane.INTERACTIVE):
+            await self.bot.send_document(
+                chat_id=delivery.tg_id,
+                document=getattr(item, f'fail_{delivery.data_type}'),
+                caption=f"{DATA_NAMES[delivery.data_type]}: {getattr(item, f'name_fail_{delivery.data_type}')}"
+            )
+
+    async def _finish_order(self, delivery):
+        await rq.set_order_status(delivery.order_id, 'confirmed', 'delivered')
+        funnel.hit('delivered', delivery.data_type, delivery.item_id)
+        order = await rq.get_order(delivery.order_id)
+        # Оплата звездами возвращается после выдачи, как и раньше; переход статуса не даст сделать это дважды
+        if order.method == 'stars' and await rq.set_order_status(order.id, 'delivered', 'refunded'):
+            try:
+                await self.bot.refund_star_payment(order.tg_id, order.charge_id)
+            except Exception as e:
+                await rq.set_order_status(order.id, 'refunded', 'delivered')
+                logger.error(f"Ошибка при возврате оплаты по заказу {order.id}: {e}")
+
+    async def _process(self, delivery):
+        attempts = delivery.attempts + 1
+        try:
+            await self._send(delivery)
+        except TelegramRetryAfter as e:
+            # Флуд-лимит - не вина выдачи, попытку не считаем
+            await rq.update_delivery(delivery.id, status='pending', next_attempt_at=time.time() + e.retry_after,
+                                     last_error=str(e))
+            self.wakeup.set()
+            return
+        except (TelegramForbiddenError, PermanentDeliveryError) as e:
+            await self._dead(delivery, attempts, e)
+            return
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                await self._dead(delivery, attempts, e)
+                return
+            delay = backoff(attempts)
+            logger.warning(f"Выдача {delivery.id} не удалась (попытка {attempts}), повтор через {delay:.0f} с: {e}")
+            await rq.update_delivery(delivery.id, status='pending', attempts=attempts,
+                                     next_attempt_at=time.time() + delay, last_error=str(e))
+            # Цикл мог уснуть на DELIVERY_POLL_INTERVAL, пока выдача была в 'sending': пусть пересчитает срок
+            self.wakeup.set()
+            return
+        await rq.update_delivery(delivery.id, status='done', attempts=attempts, last_error=None)
+        logger.info(f"Выдача {delivery.id} по заказу {delivery.order_id} доставлена {delivery.tg_id}")
+        try:
+            await self._finish_order(delivery)
+        except Exception as e:
+            logger.error(f"Не удалось закрыть заказ {delivery.order_id}: {e}")
+
+    async def _dead(self, delivery, attempts, error):
+        await rq.update_delivery(delivery.id, status='dead', attempts=attempts, last_error=str(error))
+        logger.error(f"Выдача {delivery.id} по заказу {delivery.order_id} не доставлена: {error}")
+        data_name = DATA_NAMES.get(delivery.data_type, '').lower()
+        try:
+            await self.bot.send_message(
+                chat_id=delivery.tg_id,
+                text=f"Не удалось отправить вам {data_name}. Мы работаем уже над этой проблемой. "
+                     f"Обязательно вам пришлем {data_name}, как решим данную ошибку. "
+                     "Приносим свои извинения, за предоставленные неудобства!"
+            )
+        except Exception:
+            pass
+        with lane(Lane.ADMIN):
+            for admin_id in ADMIN_IDS:
+                try:
+                    await self.bot.send_message(
+                        chat_id=admin_id,
+                        text=f"⚠️ Не удалось выдать {data_name} по заказу №{delivery.order_id} "
+                             f"после {attempts} попыток: {str(error)[:200]}\nСписок: /deliveries"
+                    )
+                except Exception as e:
+                    logger.error(f"Не удалось уведомить админа {admin_id}: {e}")
+
+    async def _run_one(self, delivery):
+        try:
+            await self._process(delivery)
+        except Exception as e:
+            # Ошибка записи в базу: вернем выдачу в очередь, чтобы не застряла в 'sending'
+            logger.error(f"Сбой обработки выдачи {delivery.id}: {e}")
+            try:
+                await rq.update_delivery(delivery.id, status='pending', next_attempt_at=time.time() + DELIVERY_BASE_DELAY)
+            except Exception:
+                pass
+            self.wakeup.set()
+        finally:
+            self.slots.release()
+
+    async def _loop(self):
+        while True:
+            self.wakeup.clear()
+            # Забираем столько выдач, сколько свободных слотов
+            await self.slots.acquire()
+            free = 1
+            while free < self.workers and not self.slots.locked():
+                await self.slots.acquire()
+                free += 1
+            try:
+                deliveries = await rq.claim_due_deliveries(time.time(), free)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать очередь выдачи: {e}")
+                deliveries = []
+            for _ in range(free - len(deliveries)):
+                self.slots.release()
+            for delivery in deliveries:
+                task = asyncio.create_task(self._run_one(delivery))
+                self.in_flight.add(task)
+                task.add_done_callback(self.in_flight.discard)
+            if len(deliveries) == free:
+                continue
+            try:
+                next_at = await rq.get_next_delivery_time()
+            except Exception as e:
+                logger.error(f"Не удалось прочитать очередь выдачи: {e}")
+                next_at = None
+            timeout = DELIVERY_POLL_INTERVAL if next_at is None else min(DELIVERY_POLL_INTERVAL, max(0.0, next_at - time.time()))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        restored = await rq.reset_sending_deliveries()
+        if restored:
+            logger.info(f"Возвращено в очередь незавершенных выдач: {restored}")
+        missing = await rq.enqueue_missing_deliveries()
+        if missing:
+            logger.warning(f"Поставлено в очередь выдач подтвержденных заказов без выдачи: {missing}")
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.in_flight:
+            await asyncio.wait(self.in_flight, timeout=10)
+
+
+delivery_queue = DeliveryQueue()
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from aiogram import Bot, html
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import FSInputFile
+from dotenv import load_dotenv
+
+import database.requests as rq
+from database.catalog import catalog
+from utils.delivery import ADMIN_IDS, DATA_NAMES
+from utils.ratelimit import Lane, PerChatLimiter, TokenBucket, lane
+from utils.scheduler import deletions
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Оригиналы файлов каталога: data/originals/<gaid|kurs>/<id товара>/<photo|fail>.<расширение>
+ORIGINALS_DIR = Path(os.getenv('ORIGINALS_DIR', 'data/originals'))
+# Скачивать в хранилище оригиналы живых файлов, которых там еще нет
+ORIGINALS_BACKFILL = os.getenv('ORIGINALS_BACKFILL', '1') == '1'
+FILE_CHECK_INTERVAL = float(os.getenv('FILE_CHECK_INTERVAL', 24 * 3600))
+FILE_CHECK_FIRST_DELAY = 60.0
+# get_file не входит в общий лимит бота (UNLIMITED_METHODS), поэтому у проверки свой
+FILE_CHECK_RATE = float(os.getenv('FILE_CHECK_RATE', 5))
+FILE_CHECK_BATCH = 20
+
+# Поля товара с file_id: фото обложки и сам файл
+KINDS = ('photo', 'fail')
+
+
+@dataclass
+class FileCheckReport:
+    checked: int = 0
+    refreshed: list[str] = field(default_factory=list)
+    missing: list[str] = field(default_factory=list)  # битые без оригинала
+    errors: list[str] = field(default_factory=list)
+    backfilled: int = 0
+
+    @property
+    def healthy(self) -> bool:
+        return not (self.refreshed or self.missing or self.errors)
+
+    def text(self) -> str:
+        lines = [f"🩺 Проверка файлов каталога: проверено {self.checked}"]
+        if self.backfilled:
+            lines.append(f"Сохранено оригиналов: {self.backfilled}")
+        if self.refreshed:
+            lines.append(f"Обновлено из оригиналов ({len(self.refreshed)}):")
+            lines.extend(f"• {name}" for name in self.refreshed)
+        if self.missing:
+            lines.append(f"❌ Битые, оригинала нет - загрузите товар заново ({len(self.missing)}):")
+            lines.extend(f"• {name}" for name in self.missing)
+        if self.errors:
+            lines.append(f"Не удалось проверить ({len(self.errors)}):")
+            lines.extend(f"• {name}" for name in self.errors)
+        if self.healthy:
+            lines.append("Все file_id живые ✅")
+        return '\n'.join(lines)
+
+
+def original_path(data_type: str, item_id: int, kind: str) -> Path | None:
+    return next(iter(sorted((ORIGINALS_DIR / data_type / str(item_id)).glob(f'{kind}.*'))), None)
+
+
+class FileHealthChecker:
+    """Периодически проверяет file_id обложек и файлов каталога через get_file.
+
+    Битый file_id заменяется новым: оригинал из хранилища загружается в чат
+    админа, сообщение сразу ставится на удаление, а новый file_id пишется в базу.
+    Живые файлы, которых нет в хранилище, туда скачиваются, чтобы было из чего
+    восстанавливать. Итог проверки уходит админам.
+    """
+
+    def __init__(self, rate: float = FILE_CHECK_RATE, interval: float = FILE_CHECK_INTERVAL):
+        self.bucket = TokenBucket(rate)
+        # Все перезагрузки идут в один чат админа
+        self.chat_limiter = PerChatLimiter()
+        self.interval = interval
+        self.bot: Bot | None = None
+        self.task: asyncio.Task | None = None
+        self.lock = asyncio.Lock()
+
+    async def _reupload(self, kind: str, path: Path) -> str:
+        await self.chat_limiter.acquire(ADMIN_IDS[0])
+        try:
+            with lane(Lane.ADMIN):
+                if kind == 'photo':
+                    message = await self.bot.send_photo(ADMIN_IDS[0], FSInputFile(path), disable_notification=True)
+                    file_id = message.photo[-1].file_id
+                else:
+                    message = await self.bot.send_document(ADMIN_IDS[0], FSInputFile(path), disable_notification=True)
+                    file_id = message.document.file_id
+        except TelegramRetryAfter as e:
+            # Следующие перезагрузки подождут, эта попадет в отчет и повторится при следующей проверке
+            self.chat_limiter.pause(ADMIN_IDS[0], e.retry_after)
+            raise
+        deletions.schedule(message, 0)
+        return file_id
+
+    async def _check_one(self, data_type: str, item, kind: str, report: FileCheckReport):
+        column = f'{kind}_{data_type}'
+        file_id = getattr(item, column)
+        label = f"{DATA_NAMES[data_type]} «{html.quote(getattr(item, f'name_fail_{data_type}'))}», {'обложка' if kind == 'photo' else 'файл'}"
+        await self.bucket.acquire()
+        report.checked += 1
+        try:
+            file = await self.bot.get_file(file_id)
+        except TelegramBadRequest as e:
+            if 'too big' in str(e):
+                # Файл жив, просто больше 20 МБ и не отдается ботам на скачивание
+                return
+            logger.warning(f"Битый file_id: {label}: {e}")
+            path = original_path(data_type, item.id, kind)
+            if path is None:
+                report.missing.append(label)
+                return
+            try:
+                new_file_id = await self._reupload(kind, path)
+                await rq.update_item_files(data_type, item.id, {column: new_file_id})
+                report.refreshed.append(label)
+            except Exception as e:
+                logger.error(f"Не удалось обновить {label} из {path}: {e}")
+                report.errors.append(label)
+            return
+        except Exception as e:
+            logger.error(f"Не удалось проверить {label}: {e}")
+            report.errors.append(label)
+            return
+
+        if ORIGINALS_BACKFILL and file.file_path and original_path(data_type, item.id, kind) is None:
+            destination = ORIGINALS_DIR / data_type / str(item.id) / f'{kind}{Path(file.file_path).suffix}'
+            try:
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                await self.bot.download_file(file.file_path, destination)
+                report.backfilled += 1
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить оригинал {label}: {e}")
+
+    async def check(self) -> FileCheckReport:
+        async with self.lock:
+            report = FileCheckReport()
+            snapshot = await catalog.get()
+            checks = [
+                (data_type, item, kind)
+                for data_type, items in snapshot.items.items()
+                for item in items
+                for kind in KINDS
+            ]
+            for start in range(0, len(checks), FILE_CHECK_BATCH):
+                await asyncio.gather(*(
+                    self._check_one(data_type, item, kind, report)
+                    for data_type, item, kind in checks[start:start + FILE_CHECK_BATCH]
+                ))
+            logger.info(f"Проверка файлов: проверено {report.checked}, обновлено {len(report.refreshed)}, "
+                        f"без оригинала {len(report.missing)}, ошибок {len(report.errors)}")
+            return report
+
+    async def report_to_admins(self, report: FileCheckReport):
+        with lane(Lane.ADMIN):
+            for admin_id in ADMIN_IDS:
+                try:
+                    await self.bot.send_message(admin_id, report.text())
+                except Exception as e:
+                    logger.error(f"Не удалось отправить отчет о файлах админу {admin_id}: {e}")
+
+    async def _loop(self):
+        await asyncio.sleep(FILE_CHECK_FIRST_DELAY)
+        while True:
+            try:
+                report = await self.check()
+                # По расписанию беспокоим админов только при проблемах
+                if not report.healthy:
+                    await self.report_to_admins(report)
+            except Exception as e:
+                logger.error(f"Сбой проверки файлов: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        if self.task is None and ADMIN_IDS:
+            self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+file_health = FileHealthChecker()
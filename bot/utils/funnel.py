@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+import database.requests as rq
+
+
+logger = logging.getLogger(__name__)
+
+# Этапы воронки по порядку
+STAGES = ('start', 'catalog_open', 'select', 'payment_start', 'payment_confirmed', 'delivered')
+STAGE_NAMES = {
+    'start': '/start',
+    'catalog_open': 'Открыли каталог',
+    'select': 'Выбрали товар',
+    'payment_start': 'Начали оплату',
+    'payment_confirmed': 'Оплатили',
+    'delivered': 'Получили файл',
+}
+
+WINDOW_HOURS = int(os.getenv('FUNNEL_WINDOW_HOURS', 24 * 7))
+FLUSH_INTERVAL = float(os.getenv('FUNNEL_FLUSH_INTERVAL', 60))
+
+
+def current_hour() -> int:
+    return int(time.time() // 3600)
+
+
+class FunnelCounters:
+    """Живые счетчики воронки по часам и товарам.
+
+    Событие - это инкремент в памяти, чтение - сумма по часовым корзинам окна.
+    Приросты периодически прибавляются к таблице funnel_counters, а при старте
+    окно восстанавливается из нее, так что перезапуск не обнуляет цифры.
+    """
+
+    def __init__(self, window_hours: int = WINDOW_HOURS, flush_interval: float = FLUSH_INTERVAL):
+        self.window_hours = window_hours
+        self.flush_interval = flush_interval
+        # час -> {(этап, тип, id товара): количество}
+        self.buckets: dict[int, Counter] = {}
+        # (час, этап, тип, id товара) -> еще не записанный прирост
+        self.pending: Counter = Counter()
+        self.task: asyncio.Task | None = None
+
+    def hit(self, stage: str, data_type: str = '', item_id: int = 0):
+        hour = current_hour()
+        bucket = self.buckets.get(hour)
+        if bucket is None:
+            bucket = self.buckets[hour] = Counter()
+            self._prune(hour)
+        bucket[(stage, data_type, item_id)] += 1
+        self.pending[(hour, stage, data_type, item_id)] += 1
+
+    def _prune(self, hour: int):
+        for old in [h for h in self.buckets if h <= hour - self.window_hours]:
+            del self.buckets[old]
+
+    def totals(self, hours: int = 24) -> Counter:
+        """Суммы за последние hours часов: {(этап, тип, id товара): количество}."""
+        since = current_hour() - min(hours, self.window_hours) + 1
+        result = Counter()
+        for hour, bucket in self.buckets.items():
+            if hour >= since:
+                result.update(bucket)
+        return result
+
+    async def load(self):
+        since = current_hour() - self.window_hours + 1
+        self.buckets = {}
+        for row in await rq.get_funnel_counts(since):
+            self.buckets.setdefault(row.hour, Counter())[(row.stage, row.data_type, row.item_id)] += row.count
+        # Приросты, набежавшие до загрузки, уже учтены в pending и попадут в базу при сбросе
+        for (hour, stage, data_type, item_id), count in self.pending.items():
+            if hour >= since:
+                self.buckets.setdefault(hour, Counter())[(stage, data_type, item_id)] += count
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, Counter()
+        rows = [
+            {'hour': hour, 'stage': stage, 'data_type': data_type, 'item_id': item_id, 'count': count}
+            for (hour, stage, data_type, item_id), count in pending.items()
+        ]
+        try:
+            await rq.add_funnel_counts(rows)
+        except Exception as e:
+            logger.error(f"Не удалось записать счетчики воронки: {e}")
+            # Вернем приросты, чтобы не потерять их до следующей попытки
+            self.pending.update(pending)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+
+funnel = FunnelCounters()
@@ -0,0 +1,26 @@
+from collections import deque
+
+
+class LatencyStats:
+    """Задержки последних size измерений: перцентили считаются по скользящему окну."""
+
+    def __init__(self, name: str, size: int = 1000):
+        self.name = name
+        self.samples: deque[float] = deque(maxlen=size)
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, share: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+    def summary(self) -> str:
+        return (f"{self.name}: {self.count} шт., p50 {self.percentile(0.5) * 1000:.1f} мс, "
+                f"p99 {self.percentile(0.99) * 1000:.1f} мс, max {self.max * 1000:.1f} мс")
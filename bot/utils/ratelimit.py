@@ -0,0 +1,204 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate запросов в секунду с запасом capacity."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после TelegramRetryAfter)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self, tokens: float = 1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class PerChatLimiter:
+    """Не чаще одного запроса в interval секунд в один и тот же чат."""
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.next_allowed: dict[int, float] = {}
+
+    def _prune(self, now: float):
+        if len(self.next_allowed) > 10000:
+            self.next_allowed = {chat_id: ts for chat_id, ts in self.next_allowed.items() if ts > now}
+
+    async def acquire(self, chat_id: int):
+        now = time.monotonic()
+        ready_at = self.next_allowed.get(chat_id, 0.0)
+        self.next_allowed[chat_id] = max(now, ready_at) + self.interval
+        self._prune(now)
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+
+    def pause(self, chat_id: int, seconds: float):
+        self.next_allowed[chat_id] = time.monotonic() + seconds
+
+
+class Lane(IntEnum):
+    """Приоритет исходящих запросов к Bot API: чем меньше, тем раньше."""
+    INTERACTIVE = 0
+    ADMIN = 1
+    BULK = 2
+
+
+current_lane: ContextVar[Lane] = ContextVar('current_lane', default=Lane.INTERACTIVE)
+
+
+@contextmanager
+def lane(value: Lane):
+    """Все запросы к Bot API внутри блока идут в указанной полосе."""
+    token = current_lane.set(value)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+# Запросы, которые не отправляют сообщений и не расходуют лимит Telegram
+UNLIMITED_METHODS = {
+    'AnswerCallbackQuery', 'AnswerPreCheckoutQuery', 'AnswerInlineQuery', 'GetFile', 'GetMe',
+    'GetUpdates', 'SetWebhook', 'DeleteWebhook', 'GetWebhookInfo', 'SetMyCommands',
+}
+
+
+class PriorityRateLimiter(BaseRequestMiddleware):
+    """Общий лимит запросов бота с приоритетными полосами.
+
+    Токены раздаются по приоритету полос, а рассылке (Lane.BULK) доступны только
+    токены сверх резерва, поэтому ответы пользователям и платежи не ждут в очереди
+    за массовой рассылкой.
+
+    TelegramRetryAfter останавливает только то, что его получило: запросы в этот
+    чат, а если чат неизвестен или 429 пришел рассылке - еще и полосу. Остальные
+    полосы продолжают работать.
+    """
+
+    def __init__(self, rate: float = 30, capacity: float | None = None, reserve: dict[Lane, float] | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.reserve = reserve if reserve is not None else {Lane.INTERACTIVE: 0, Lane.ADMIN: 0, Lane.BULK: 5}
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until: dict[Lane, float] = {value: 0.0 for value in Lane}
+        self.chats = PerChatLimiter(interval=0)
+        self.waiters: dict[Lane, deque[asyncio.Future]] = {value: deque() for value in Lane}
+        self.dispatcher: asyncio.Task | None = None
+        self.wakeup = asyncio.Event()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _next_waiter(self, up_to: Lane = Lane.BULK, now: float | None = None) -> tuple[Lane, asyncio.Future] | None:
+        for value in Lane:
+            if value > up_to:
+                break
+            if now is not None and now < self.blocked_until[value]:
+                continue
+            queue = self.waiters[value]
+            while queue and queue[0].done():
+                queue.popleft()
+            if queue:
+                return value, queue[0]
+        return None
+
+    def pause(self, seconds: float, value: Lane):
+        """Останавливает выдачу токенов одной полосе (например, после TelegramRetryAfter)."""
+        self.blocked_until[value] = max(self.blocked_until[value], time.monotonic() + seconds)
+
+    async def _sleep(self, seconds: float):
+        # Просыпаемся раньше, если в очередь встал запрос, который может пройти раньше
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            waiter = self._next_waiter(now=now)
+            if waiter is None:
+                blocked = [self.blocked_until[value] for value in Lane
+                           if self.waiters[value] and self.blocked_until[value] > now]
+                if not blocked:
+                    self.dispatcher = None
+                    return
+                # Ждут только полосы на паузе
+                await self._sleep(min(blocked) - now)
+                continue
+            value, future = waiter
+            self._refill(now)
+            needed = 1 + self.reserve[value]
+            if self.tokens >= needed:
+                self.tokens -= 1
+                self.waiters[value].popleft()
+                future.set_result(None)
+            else:
+                await self._sleep((needed - self.tokens) / self.rate)
+
+    async def acquire(self, value: Lane):
+        now = time.monotonic()
+        self._refill(now)
+        # Быстрый путь: впереди нет запросов того же или более высокого приоритета и токен свободен
+        if (now >= self.blocked_until[value] and self._next_waiter(value, now) is None
+                and self.tokens >= 1 + self.reserve[value]):
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[value].append(future)
+        self.wakeup.set()
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def __call__(self, make_request, bot, method):
+        value = current_lane.get()
+        chat_id = getattr(method, 'chat_id', None)
+        if not isinstance(chat_id, int):
+            chat_id = None
+        if type(method).__name__ not in UNLIMITED_METHODS:
+            if chat_id is not None:
+                # Чат после 429 ждет сам, не занимая очередь полосы
+                await self.chats.acquire(chat_id)
+            await self.acquire(value)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            if chat_id is not None:
+                self.chats.pause(chat_id, e.retry_after)
+            if chat_id is None or value == Lane.BULK:
+                self.pause(e.retry_after, value)
+            raise
@@ -0,0 +1,105 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import defaultdict
+
+from aiogram import Bot
+from aiogram.types import Message
+
+import database.requests as rq
+from database.batcher import WriteBehindBatcher
+from utils.ratelimit import Lane, lane
+
+
+logger = logging.getLogger(__name__)
+
+# delete_messages принимает не больше 100 id за раз
+DELETE_CHUNK_SIZE = 100
+
+
+class DeletionScheduler:
+    """Удаляет сообщения по таймеру вместо asyncio.sleep в обработчиках.
+
+    Таймеры лежат в куче по времени удаления и дублируются в таблице
+    scheduled_deletions, так что перезапуск их не теряет. Одна фоновая задача
+    спит до ближайшего таймера, забирает все наступившие и удаляет их пачками
+    delete_messages по чатам.
+    """
+
+    def __init__(self):
+        self.heap: list[tuple[float, int, int]] = []
+        self.wakeup = asyncio.Event()
+        self.saver = WriteBehindBatcher(rq.add_scheduled_deletions)
+        self.bot: Bot | None = None
+        self.task: asyncio.Task | None = None
+
+    def schedule(self, message: Message | None, delay: float):
+        """Ставит сообщение на удаление через delay секунд и сразу возвращает управление."""
+        if message is None:
+            return
+        self.schedule_id(message.chat.id, message.message_id, delay)
+
+    def schedule_id(self, chat_id: int, message_id: int, delay: float):
+        delete_at = time.time() + delay
+        entry = (delete_at, chat_id, message_id)
+        heapq.heappush(self.heap, entry)
+        self.saver.add(entry[1:] + (delete_at,))
+        if self.heap[0] is entry:
+            self.wakeup.set()
+
+    def _pop_due(self, now: float) -> dict[int, list[int]]:
+        due = defaultdict(list)
+        while self.heap and self.heap[0][0] <= now:
+            _, chat_id, message_id = heapq.heappop(self.heap)
+            due[chat_id].append(message_id)
+        return due
+
+    async def _delete(self, chat_id: int, message_ids: list[int]):
+        for start in range(0, len(message_ids), DELETE_CHUNK_SIZE):
+            chunk = message_ids[start:start + DELETE_CHUNK_SIZE]
+            try:
+                with lane(Lane.BULK):
+                    await self.bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+            except Exception as e:
+                # Сообщение уже удалено или старше 48 часов - повторять бессмысленно
+                logger.warning(f"Не удалось удалить сообщения {chunk} в чате {chat_id}: {e}")
+            try:
+                await rq.remove_scheduled_deletions(chat_id, chunk)
+            except Exception as e:
+                logger.error(f"Не удалось снять удаления {chunk} в чате {chat_id}: {e}")
+
+    async def _loop(self):
+        while True:
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = self._pop_due(time.time())
+            # Удаляемые сейчас строки должны быть в базе до того, как мы их снимем
+            await self.saver.flush()
+            await asyncio.gather(*(self._delete(chat_id, message_ids) for chat_id, message_ids in due.items()))
+
+    async def start(self, bot: Bot):
+        """Поднимает таймеры из базы (просроченные сработают сразу) и запускает обработку."""
+        self.bot = bot
+        for row in await rq.get_scheduled_deletions():
+            heapq.heappush(self.heap, (row.delete_at, row.chat_id, row.message_id))
+        if self.heap:
+            logger.info(f"Восстановлено отложенных удалений: {len(self.heap)}")
+        self.saver.start()
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.saver.stop()
+
+
+deletions = DeletionScheduler()